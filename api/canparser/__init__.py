@@ -0,0 +1,491 @@
+"""
+Reads car datalogger CSV files and decodes their CAN frames using a DBC file.
+
+This is a modified version of WURacing/canparser to fix timezone issue and also be braver than thomas.
+It doesn't depend on the API app, so the telemetry server can share the same decoder.
+"""
+import abc
+import csv
+import datetime
+import io
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import cantools.database
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Make sure this is whatever the car uses
+timezone = datetime.timezone(-datetime.timedelta(hours=5), "Central Daylight Time")
+EXTENDED_MASK = 0x1FFFFFFF
+STANDARD_MASK = 0x7FF
+
+# Raw datalogger CSV layout
+PACKET_COLUMNS = ["year", "month", "day", "hour", "min", "sec", "ms", "id", "data"]
+DATE_FIELD_RANGES = {
+    "year": (1, 9999),
+    "month": (1, 12),
+    "day": (1, 31),
+    "hour": (0, 23),
+    "min": (0, 59),
+    "sec": (0, 59),
+    "ms": (0, 999),
+}
+DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+PACKET_BLOCK_SIZE = 100000
+
+# Decoded (long form) signal CSV layout
+SIGNAL_COLUMNS = ["timestamp", "sig_name", "sig_val"]
+
+# Lookup table from ASCII character to hex digit value
+HEX_INVALID = 0xFF
+HEX_PAD = 0xFE
+HEX_DIGITS = np.full((256,), HEX_INVALID, dtype=np.uint8)
+HEX_DIGITS[0] = HEX_PAD
+for _i, _c in enumerate(b"0123456789abcdef"):
+    HEX_DIGITS[_c] = HEX_DIGITS[ord(chr(_c).upper())] = _i
+HEX_PREFIX_OR_SPACE = np.frombuffer(b"xX \t\r\n", dtype=np.uint8)
+
+
+@dataclass
+class Packet:
+    timestamp: int
+    epoch: bool
+    extended: bool
+    msg_id: int
+    data: bytes
+
+
+@dataclass
+class PacketBlock:
+    timestamps: np.ndarray  # int64 milliseconds since the epoch
+    msg_ids: np.ndarray  # uint32 frame IDs
+    data: np.ndarray  # uint8 payloads, one row of 8 bytes per packet
+
+    def __len__(self):
+        return self.timestamps.shape[0]
+
+
+def char_matrix(column: pd.Series) -> np.ndarray:
+    """
+    Convert a column of ASCII strings to a matrix of characters, one row per string, left-aligned and zero-padded
+    """
+    try:
+        chars = column.to_numpy().astype("S")
+    except UnicodeEncodeError:
+        chars = np.array(column.str.encode("ascii", errors="replace").tolist(), dtype="S")
+    width = max(chars.dtype.itemsize, 1)
+    return chars.view(np.uint8).reshape((chars.shape[0], width))
+
+
+def days_since_epoch(year, month, day):
+    # days from civil, see http://howardhinnant.github.io/date_algorithms.html
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    yoe = year - era * 400
+    doy = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def packet_block_from_rows(rows: pd.DataFrame):
+    """
+    Convert raw datalogger CSV rows to packet arrays
+    :param rows: Block of rows with the PACKET_COLUMNS columns
+    :return: the PacketBlock of rows before the first invalid one, and whether every row was valid
+    """
+    n = rows.shape[0]
+    valid = np.ones((n,), dtype=bool)
+    fields = {}
+    for column, (low, high) in DATE_FIELD_RANGES.items():
+        values = pd.to_numeric(rows[column], errors='coerce').to_numpy(dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            valid &= (values >= low) & (values <= high) & (values == np.floor(values))
+        fields[column] = np.nan_to_num(values).astype(np.int64)
+    leap = (fields["year"] % 4 == 0) & ((fields["year"] % 100 != 0) | (fields["year"] % 400 == 0))
+    valid &= fields["day"] <= DAYS_IN_MONTH[np.clip(fields["month"], 0, 12)] + (leap & (fields["month"] == 2))
+
+    ids = rows["id"].astype(str)
+    chars = char_matrix(ids)
+    if np.isin(chars, HEX_PREFIX_OR_SPACE).any():  # rare, so only pay for string operations when needed
+        chars = char_matrix(ids.str.strip().str.replace('^0[xX]', '', regex=True))
+    digits = HEX_DIGITS[chars]
+    length = (digits != HEX_PAD).sum(axis=1)
+    valid &= (length > 0) & (digits != HEX_INVALID).all(axis=1)
+    msg_ids = np.zeros((n,), dtype=np.uint64)
+    for i in range(digits.shape[1]):
+        msg_ids = np.where(i < length, (msg_ids << np.uint64(4)) | digits[:, i], msg_ids)
+
+    payloads = rows["data"].astype(str)
+    chars = char_matrix(payloads)
+    if np.isin(chars, HEX_PREFIX_OR_SPACE).any():
+        chars = char_matrix(payloads.str.replace(r'\s', '', regex=True))
+    digits = HEX_DIGITS[chars]
+    length = (digits != HEX_PAD).sum(axis=1)
+    # a payload must decode to at least 8 bytes
+    valid &= (length >= 16) & (length % 2 == 0) & (digits != HEX_INVALID).all(axis=1)
+
+    count = n if valid.all() else int(np.argmin(valid))
+
+    # whole milliseconds, local time, then shifted to UTC
+    f = {column: values[:count] for column, values in fields.items()}
+    days = days_since_epoch(f["year"], f["month"], f["day"])
+    timestamps = ((days * 24 + f["hour"]) * 60 + f["min"]) * 60 + f["sec"]
+    timestamps = timestamps * 1000 + f["ms"] - int(timezone.utcoffset(None) / datetime.timedelta(milliseconds=1))
+
+    msg_ids = (msg_ids[:count] & EXTENDED_MASK).astype(np.uint32)
+    data = digits[:count, 0:16:2] * 16 + digits[:count, 1:16:2]
+    if count == 0:
+        data = np.zeros((0, 8), dtype=np.uint8)
+
+    return PacketBlock(timestamps, msg_ids, data.astype(np.uint8)), count == n
+
+
+@dataclass
+class Signal:
+    timestamp: int
+    epoch: bool
+    sender: str
+    msg_name: str
+    sig_name: str
+    sig_val: float
+    units: str
+
+@dataclass
+class Message:
+    timestamp: int
+    epoch: bool
+    msg_id: int
+    msg_name: str
+    sender: str
+    signals: List[Signal]
+
+
+class LogReader(abc.ABC):
+    """
+    Reads a CSV log in blocks of rows, either whole or one piece of it at a time
+    """
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        # approximate number of bytes consumed from the input so far, for progress reporting
+        self.position = 0
+        # whether the last read reached the end of its input, rather than stopping at a malformed row
+        self.complete = True
+
+    def read_rows(self, required_columns, dtype, block_size, byte_range=None):
+        """
+        :param required_columns: Columns to read. The file is rejected if any are missing
+        :param dtype: Column types for pandas
+        :param block_size: Number of rows to read at a time
+        :param byte_range: Optional (start, end) offsets of whole lines to read instead of the entire file
+        :return: generator of DataFrames
+        """
+        self.position = 0
+        self.complete = True
+        with open(self.input_file, 'r', newline='', errors='ignore') as f:
+            fieldnames = next(csv.reader([f.readline()]), [])
+            if any(column not in fieldnames for column in required_columns):
+                raise ValueError("Invalid CSV file format")
+            if byte_range is None:
+                body, offset = f, None
+            else:
+                offset, end = byte_range
+                f.buffer.seek(offset)
+                body = io.StringIO(f.buffer.read(end - offset).decode(f.encoding, errors='ignore'), newline='')
+            reader = pd.read_csv(body, header=None, names=fieldnames, usecols=required_columns, dtype=dtype,
+                                 na_filter=False, chunksize=block_size)
+            try:
+                for chunk in reader:
+                    self.position = f.buffer.tell() if offset is None else offset + body.tell()
+                    yield chunk
+            except pd.errors.ParserError as e:
+                logger.warning(f"Stopped reading {self.input_file}: {e}")
+                self.complete = False
+
+    def byte_ranges(self, chunk_size):
+        """
+        Split the body of the CSV (after the header) into pieces that can be read independently
+        :param chunk_size: Approximate size of each piece in bytes
+        :return: list of (start, end) offsets, each starting and ending on a line boundary
+        """
+        ranges = []
+        with open(self.input_file, 'rb') as f:
+            f.readline()
+            start = f.tell()
+            size = os.fstat(f.fileno()).st_size
+            while start < size:
+                f.seek(min(start + chunk_size, size))
+                f.readline()  # finish the line we landed in
+                end = min(f.tell(), size)
+                ranges.append((start, end))
+                start = end
+        return ranges
+
+    @abc.abstractmethod
+    def blocks(self, block_size=PACKET_BLOCK_SIZE, byte_range=None):
+        """
+        Read and decode the log in blocks
+        :param block_size: Number of rows to parse at a time
+        :param byte_range: Optional (start, end) offsets of whole lines to read instead of the entire file
+        :return: generator of DecodedBlock
+        """
+
+
+class CANParser(LogReader):
+    """
+    Raw datalogger logs: one CAN frame per row, decoded with the DBC
+    """
+
+    def __init__(self, dbc_file, input_file):
+        super().__init__(input_file)
+        self.db = cantools.database.load_file(dbc_file)
+        self.decoder = CompiledDecoder(self.db)
+
+    def packet_blocks(self, block_size=PACKET_BLOCK_SIZE, byte_range=None):
+        """
+        Read the datalogger CSV in blocks of rows, converting each block to arrays at once
+        :param block_size: Number of rows to parse at a time
+        :param byte_range: Optional (start, end) offsets of whole lines to read instead of the entire file
+        :return: generator of PacketBlock, stopping before the first malformed row or short payload
+        """
+        for rows in self.read_rows(PACKET_COLUMNS, {"id": str, "data": str}, block_size, byte_range):
+            block, complete = packet_block_from_rows(rows)
+            if len(block) > 0:
+                yield block
+            if not complete:
+                self.complete = False
+                break
+
+    def packets(self):
+        for block in self.packet_blocks():
+            for timestamp, msg_id, data in zip(block.timestamps.tolist(), block.msg_ids.tolist(), block.data):
+                # Epoch and extended are assumed for now
+                yield Packet(timestamp, False, True, msg_id, data.tobytes())
+
+    def blocks(self, block_size=PACKET_BLOCK_SIZE, byte_range=None):
+        for block in self.packet_blocks(block_size, byte_range):
+            yield self.decoder.decode_block(block)
+
+    def messages(self):
+        for packet in self.packets():
+            msg = self.decoder.decode_message(packet)
+            if msg is not None:
+                yield msg
+
+
+class SignalLogParser(LogReader):
+    """
+    Logs that were already decoded by canparser: one signal value per row, in long form
+    """
+
+    def blocks(self, block_size=PACKET_BLOCK_SIZE, byte_range=None):
+        for rows in self.read_rows(SIGNAL_COLUMNS, {"sig_name": str}, block_size, byte_range):
+            block, complete = signal_block_from_rows(rows)
+            if len(block) > 0:
+                yield block
+            if not complete:
+                self.complete = False
+                break
+
+
+def signal_block_from_rows(rows: pd.DataFrame):
+    """
+    Pivot long-form signal rows to a wide block
+    :param rows: Block of rows with the SIGNAL_COLUMNS columns
+    :return: the DecodedBlock of rows before the first one with an invalid timestamp, and whether there were none
+    """
+    n = rows.shape[0]
+    timestamps = pd.to_numeric(rows["timestamp"], errors='coerce').to_numpy(dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        valid = np.isfinite(timestamps) & (timestamps == np.floor(timestamps))
+    count = n if valid.all() else int(np.argmin(valid))
+
+    # values that don't parse as numbers are left out
+    values = pd.to_numeric(rows["sig_val"][:count], errors='coerce').to_numpy(dtype=np.float64)
+    present = ~np.isnan(values)
+    timestamps = timestamps[:count][present].astype(np.int64)
+    # column order is order of first appearance, like decoded CAN frames
+    cols, names = pd.factorize(rows["sig_name"][:count][present])
+
+    times, time_rows = np.unique(timestamps, return_inverse=True)
+    wide = np.full((times.shape[0], names.shape[0]), np.nan)
+    wide[time_rows, cols] = values[present]
+    return DecodedBlock(times, {name: wide[:, col] for col, name in enumerate(names)}), count == n
+
+
+def open_log(dbc_file, input_file) -> LogReader:
+    """
+    Pick the reader for a log file based on its header
+    """
+    with open(input_file, 'r', newline='', errors='ignore') as f:
+        fieldnames = next(csv.reader([f.readline()]), [])
+    if all(column in fieldnames for column in SIGNAL_COLUMNS):
+        return SignalLogParser(input_file)
+    return CANParser(dbc_file, input_file)
+
+
+@dataclass
+class SignalPlan:
+    """
+    How to pull one signal out of the 64-bit payload word
+    """
+    name: str
+    units: Optional[str]
+    big_endian: bool
+    shift: int  # position of the least significant bit within the payload word
+    length: int
+    signed: bool
+    is_float: bool
+    scale: float
+    offset: float
+    multiplexer: Optional[str]  # signal selecting whether this one is present, if multiplexed
+    multiplexer_ids: Optional[List[int]]
+
+    @staticmethod
+    def compile(signal: cantools.database.Signal):
+        if signal.byte_order == "big_endian":
+            # DBC start bit is the most significant bit, counted from the LSB of each byte. Payload word is big endian
+            msb = (7 - signal.start // 8) * 8 + signal.start % 8
+            shift = msb - signal.length + 1
+        else:
+            shift = signal.start
+        return SignalPlan(signal.name, signal.unit, signal.byte_order == "big_endian", shift, signal.length,
+                          signal.is_signed, bool(getattr(signal, "is_float", False)), signal.scale, signal.offset,
+                          signal.multiplexer_signal, signal.multiplexer_ids)
+
+    def extract(self, words: np.ndarray) -> np.ndarray:
+        """
+        Scaled values of this signal
+        :param words: uint64 payload words in this signal's byte order
+        :return: float64 values
+        """
+        raw = words >> np.uint64(self.shift)
+        if self.length < 64:
+            raw &= np.uint64((1 << self.length) - 1)
+        if self.is_float:
+            raw = raw.astype(np.uint32).view(np.float32) if self.length == 32 else raw.view(np.float64)
+        elif self.signed:
+            # sign extend by moving the sign bit to the top, then shifting back arithmetically
+            unused = np.int64(64 - self.length)
+            raw = (raw.view(np.int64) << unused) >> unused
+        with np.errstate(invalid="ignore"):  # signalling NaNs in float signals
+            return raw.astype(np.float64) * self.scale + self.offset
+
+
+@dataclass
+class MessagePlan:
+    frame_id: int
+    name: str
+    sender: str
+    signals: List[SignalPlan]
+
+    @staticmethod
+    def compile(message: cantools.database.Message):
+        """
+        I am choosing to assume that all messages will have only one sender
+        I do not see this changing on our bus any time soon, but make note
+        of this line if it does
+        """
+        sender = message.senders[0] if message.senders else ""
+        return MessagePlan(message.frame_id, message.name, sender, [SignalPlan.compile(s) for s in message.signals])
+
+    def decode(self, data: np.ndarray) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """
+        Decode every signal of many frames of this message at once
+        :param data: uint8 payloads, shape (frames, 8)
+        :return: (values, present), signal name to float64 values and to whether each frame carries the signal, which
+            a multiplexed signal only does for its multiplexer ids. Float signals may be sent as NaN
+        """
+        data = np.ascontiguousarray(data, dtype=np.uint8)
+        words = {False: data.view("<u8").reshape((-1,)), True: data.view(">u8").reshape((-1,)).astype(np.uint64)}
+        values = {s.name: s.extract(words[s.big_endian]) for s in self.signals}
+        everywhere = np.ones((data.shape[0],), dtype=bool)
+        present = {s.name: everywhere for s in self.signals}
+        for s in self.signals:
+            if s.multiplexer is not None and s.multiplexer_ids is not None:
+                present[s.name] = present[s.multiplexer] & np.isin(values[s.multiplexer], s.multiplexer_ids)
+        return values, present
+
+
+@dataclass
+class DecodedBlock:
+    """
+    Decoded signals in wide form: one row per unique timestamp, one column per signal
+    """
+    timestamps: np.ndarray  # sorted, unique int64 milliseconds since the epoch
+    columns: Dict[str, np.ndarray]  # signal name to float64 values per timestamp, NaN where not sent
+
+    def __len__(self):
+        return self.timestamps.shape[0]
+
+
+class CompiledDecoder:
+    """
+    Decodes CAN frames with extraction plans compiled once from the DBC, instead of asking cantools per frame
+    """
+
+    def __init__(self, db: cantools.database.Database):
+        self.plans = {m.frame_id: MessagePlan.compile(m) for m in db.messages}
+        self.units = {s.name: s.units for p in self.plans.values() for s in p.signals}
+        self.missing = set()
+
+    def plan(self, msg_id: int) -> Optional[MessagePlan]:
+        plan = self.plans.get(msg_id & EXTENDED_MASK)
+        if plan is None and msg_id not in self.missing:
+            logger.warning(f"Missing {msg_id} in DBC")
+            self.missing.add(msg_id)
+        return plan
+
+    def decode_frame(self, msg_id: int, data: bytes) -> Dict[str, float]:
+        """
+        Decode a single frame
+        :raises KeyError: if the frame isn't in the DBC
+        """
+        plan = self.plan(msg_id)
+        if plan is None:
+            raise KeyError(msg_id)
+        payload = np.zeros((1, 8), dtype=np.uint8)
+        payload[0, :min(len(data), 8)] = np.frombuffer(data[:8], dtype=np.uint8)
+        values, present = plan.decode(payload)
+        return {name: float(v[0]) for name, v in values.items() if present[name][0]}
+
+    def decode_message(self, packet: Packet) -> Optional[Message]:
+        plan = self.plan(packet.msg_id)
+        if plan is None:
+            return None
+        msg = Message(packet.timestamp, packet.epoch, packet.msg_id, plan.name, plan.sender, [])
+        for sig_name, sig_val in self.decode_frame(packet.msg_id, packet.data).items():
+            msg.signals.append(Signal(msg.timestamp, msg.epoch, msg.sender, msg.msg_name, sig_name, sig_val,
+                                      self.units[sig_name]))
+        return msg
+
+    def decode_block(self, block: PacketBlock) -> DecodedBlock:
+        """
+        Decode a block of packets, all frames of each message at once
+        :return: wide block; when a signal is sent more than once per timestamp, the last value is kept
+        """
+        msg_ids, first = np.unique(block.msg_ids, return_index=True)
+        known = [(msg_id, self.plan(int(msg_id))) for msg_id in msg_ids[np.argsort(first)]]
+        known = [(msg_id, plan) for msg_id, plan in known if plan is not None]
+        # frames missing from the DBC don't contribute timestamps
+        decodable = np.isin(block.msg_ids, [msg_id for msg_id, _ in known])
+        times, rows = np.unique(block.timestamps[decodable], return_inverse=True)
+        msg_ids = block.msg_ids[decodable]
+        data = block.data[decodable]
+
+        # columns in order of each message's first appearance, so the order doesn't depend on block boundaries
+        columns = {}
+        for msg_id, plan in known:
+            frames = msg_ids == msg_id
+            target = rows[frames]
+            values, present = plan.decode(data[frames])
+            for name, v in values.items():
+                if name not in columns:
+                    columns[name] = np.full((times.shape[0],), np.nan)
+                columns[name][target[present[name]]] = v[present[name]]
+        return DecodedBlock(times, columns)
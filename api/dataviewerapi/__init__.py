@@ -29,7 +29,7 @@ app.url_map.converters['time'] = TimeConverter
 
 jobs = []
 
-from . import routes, models, data
+from . import routes, models, data, commands
 import telemetryapi
 
 
@@ -43,6 +43,11 @@ def bad_request(error):
     return make_response(jsonify({'message': error.description}), 400)
 
 
+@app.before_request
+def prefetch_data():
+    data.start_prefetch()
+
+
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'models': models}
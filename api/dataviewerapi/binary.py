@@ -0,0 +1,80 @@
+"""
+Framed binary columnar format, for clients that would rather not parse text.
+
+A stream starts with the 4 bytes ``DVF1`` and a header: a little-endian uint32 length followed by that many bytes of
+JSON, ``{"columns": [{"name": ..., "dtype": ...}, ...], ...}`` plus any other metadata of the response. Batches of rows
+follow, each a uint32 row count N and then every column's N values, column after column, as raw little-endian arrays
+of the column's NumPy dtype. A row count of 0 ends the stream. Missing float values are NaN.
+
+With NumPy, a column of a batch is just ``np.frombuffer(data, dtype, count=N, offset=...)``, see read_frames.
+"""
+import json
+import struct
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from flask import request
+
+MEDIA_TYPE = "application/vnd.dataviewer.frames"
+MAGIC = b"DVF1"
+# rows per batch
+BATCH_ROWS = 65536
+
+
+def accepts_frames() -> bool:
+    """
+    Whether the current request asked for this format in its Accept header
+    """
+    return MEDIA_TYPE in request.headers.get("Accept", default="").lower()
+
+
+def encode_header(columns: List[Tuple[str, np.dtype]], **meta) -> bytes:
+    header = dict(meta, columns=[{"name": name, "dtype": np.dtype(dtype).newbyteorder("<").str}
+                                 for name, dtype in columns])
+    header = json.dumps(header).encode()
+    return MAGIC + struct.pack("<I", len(header)) + header
+
+
+def encode_batch(arrays: List[np.ndarray], dtypes: List[np.dtype]) -> bytes:
+    rows = arrays[0].shape[0]
+    return struct.pack("<I", rows) + b"".join(
+        np.ascontiguousarray(a, dtype=np.dtype(dtype).newbyteorder("<")).tobytes() for a, dtype in zip(arrays, dtypes))
+
+
+def frames(columns: List[Tuple[str, np.dtype]], batches: Iterable[List[np.ndarray]], **meta):
+    """
+    Stream batches of column arrays in this format
+    :param columns: (name, dtype) of each column
+    :param batches: lists of equal length arrays, one per column. Long ones are split into batches of BATCH_ROWS
+    :param meta: extra header fields
+    """
+    dtypes = [dtype for _, dtype in columns]
+    yield encode_header(columns, **meta)
+    for arrays in batches:
+        for start in range(0, arrays[0].shape[0], BATCH_ROWS):
+            yield encode_batch([a[start:start + BATCH_ROWS] for a in arrays], dtypes)
+    yield struct.pack("<I", 0)
+
+
+def read_frames(data: bytes) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """
+    Decode a whole stream
+    :return: (header, arrays by column name)
+    """
+    if data[:4] != MAGIC:
+        raise ValueError("Not a frames stream")
+    length, = struct.unpack_from("<I", data, 4)
+    header = json.loads(data[8:8 + length])
+    dtypes = [np.dtype(c["dtype"]) for c in header["columns"]]
+    parts = [[] for _ in dtypes]
+    offset = 8 + length
+    while True:
+        rows, = struct.unpack_from("<I", data, offset)
+        offset += 4
+        if rows == 0:
+            break
+        for part, dtype in zip(parts, dtypes):
+            part.append(np.frombuffer(data, dtype, count=rows, offset=offset))
+            offset += rows * dtype.itemsize
+    return header, {c["name"]: np.concatenate([np.zeros((0,), dtype)] + part)
+                    for c, dtype, part in zip(header["columns"], dtypes, parts)}
@@ -0,0 +1,139 @@
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import click
+from flask.cli import AppGroup
+
+from dataviewerapi import app, models
+from dataviewerapi.data import RunDataPoints, file_lock, prefetch_runs, resolve_data_file
+from dataviewerapi.jobs.run import Codec, RUN_LAYOUTS, backup_output_file, rewrite_run_file, storage_options
+from dataviewerapi.rollups import build_rollups
+from dataviewerapi.routes.testingday import read_day_schema
+
+logger = logging.getLogger(__name__)
+
+runs_cli = AppGroup("runs", help="Maintain converted run files")
+testing_cli = AppGroup("testing", help="Maintain testing day tables")
+
+# settings compared by the benchmark when none are given
+BENCHMARK_CODECS = ["none", "lzf", "lzf+shuffle", "gzip:1", "gzip:4", "gzip:4+shuffle", "gzip:9"]
+
+
+def option_overrides(layout, codec, chunk_rows, chunk_columns) -> dict:
+    options = storage_options()
+    if layout is not None:
+        options["layout"] = layout
+    if codec is not None:
+        try:
+            options["codec"] = Codec.parse(codec)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--codec")
+    if chunk_rows is not None:
+        options["block_rows"] = chunk_rows
+    if chunk_columns is not None:
+        options["block_columns"] = chunk_columns
+    return options
+
+
+def storage_args(f):
+    f = click.option("--chunk-columns", type=int, help="Variables per chunk in dense files")(f)
+    f = click.option("--chunk-rows", type=int, help="Time points per chunk")(f)
+    f = click.option("--codec", help="none, lzf, gzip or gzip:<level>, optionally followed by +shuffle")(f)
+    f = click.option("--layout", type=click.Choice(RUN_LAYOUTS))(f)
+    return f
+
+
+@runs_cli.command("rewrite")
+@click.argument("run_ids", nargs=-1, type=int)
+@storage_args
+def rewrite(run_ids, layout, codec, chunk_rows, chunk_columns):
+    """
+    Rewrite existing run files with the current storage settings (RUN_LAYOUT, RUN_CODEC, RUN_CHUNK_ROWS,
+    RUN_CHUNK_COLUMNS), or the given overrides. Rewrites every run if no ids are given.
+    """
+    options = option_overrides(layout, codec, chunk_rows, chunk_columns)
+    if not run_ids:
+        run_ids = [r.id for r in models.Run.query.order_by(models.Run.id).all()]
+    for run_id in run_ids:
+        try:
+            run_file = resolve_data_file(run_id)
+        except Exception:
+            logger.warning(f"Skipping run {run_id}, its data file isn't available")
+            continue
+        before = os.path.getsize(run_file)
+        # write next to the original and swap it in, so readers never see a partial file
+        tmp_file = f"{run_file}.rewrite"
+        # hold the lock filter jobs take, so a filter stored meanwhile isn't lost in the swap
+        with file_lock(run_file):
+            try:
+                rewrite_run_file(run_file, tmp_file, **options)
+                os.replace(tmp_file, run_file)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        backup_output_file(run_id)
+        logger.info(f"Rewrote run {run_id}: {before / 1e6:.1f} MB -> {os.path.getsize(run_file) / 1e6:.1f} MB")
+
+
+@runs_cli.command("benchmark")
+@click.argument("run_id", type=int)
+@click.option("--codec", "codecs", multiple=True, help="Codec to compare, may be repeated")
+@click.option("--chunk-rows", type=int, help="Time points per chunk")
+def benchmark(run_id, codecs, chunk_rows):
+    """
+    Compare file size and single variable read time of one run under different storage settings
+    """
+    run_file = resolve_data_file(run_id)
+    chunk_rows = chunk_rows or app.config["RUN_CHUNK_ROWS"]
+    shapes = [("dense", 16), ("dense", 1), ("sparse", 1)]
+    click.echo(f"{'layout':8} {'columns':>7} {'codec':16} {'size MB':>8} {'write s':>8} {'read ms':>8}")
+    with tempfile.TemporaryDirectory(dir=app.config["DATA_FOLDER"]) as tmp:
+        for codec in codecs or BENCHMARK_CODECS:
+            for layout, columns in shapes:
+                out_file = os.path.join(tmp, f"{run_id}.h5")
+                started = time.perf_counter()
+                rewrite_run_file(run_file, out_file, layout=layout, codec=Codec.parse(codec), block_rows=chunk_rows,
+                                 block_columns=columns)
+                written = time.perf_counter() - started
+
+                # time reading each variable on its own, as a points request for one channel would
+                reads = []
+                with RunDataPoints(run_id, out_file, cached=False) as data:
+                    for vid in data.variables():
+                        started = time.perf_counter()
+                        data.series(vid)
+                        reads.append(time.perf_counter() - started)
+                click.echo(f"{layout:8} {columns if layout == 'dense' else '-':>7} {codec:16} "
+                           f"{os.path.getsize(out_file) / 1e6:8.2f} {written:8.2f} "
+                           f"{statistics.median(reads) * 1000 if reads else 0:8.2f}")
+                os.remove(out_file)
+
+
+@runs_cli.command("prefetch")
+@click.option("--count", type=int, help="Number of most recent runs, defaults to DATA_PREFETCH_RUNS")
+def prefetch(count):
+    """
+    Download the data files of the most recent runs from the data bucket
+    """
+    prefetch_runs(count or app.config["DATA_PREFETCH_RUNS"])
+
+
+@testing_cli.command("rollup")
+@click.argument("dates", nargs=-1, type=click.DateTime(formats=["%Y-%m-%d"]))
+def rollup(dates):
+    """
+    Build the 100ms, 1s, 10s and 1m rollups of testing day tables, which coarse reads of their data are answered
+    from. Run this whenever a day table is loaded or reloaded. Builds every testing day if no dates are given
+    """
+    days = [d.date() for d in dates] or [t.date for t in models.TestingDay.query.order_by(models.TestingDay.date).all()]
+    for day in days:
+        started = time.perf_counter()
+        build_rollups(day.strftime("%Y%m%d"), read_day_schema(day).names)
+        logger.info(f"Built rollups of {day} in {time.perf_counter() - started:.1f} s")
+
+
+app.cli.add_command(runs_cli)
+app.cli.add_command(testing_cli)
@@ -14,7 +14,24 @@ class Config(object):
     UPLOAD_BUCKET = os.environ.get("UPLOAD_BUCKET")
     DATA_FOLDER = os.environ.get('DATA_FOLDER') or os.path.join(basedir, 'data', 'runs')
     DATA_BUCKET = os.environ.get("DATA_BUCKET")
+    DATA_CACHE_BYTES = int(os.environ.get("DATA_CACHE_BYTES") or 0)
+    DATA_PREFETCH_RUNS = int(os.environ.get("DATA_PREFETCH_RUNS") or 0)
+    S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+    RUN_LAYOUT = os.environ.get("RUN_LAYOUT") or "dense"
+    RUN_CODEC = os.environ.get("RUN_CODEC") or "gzip"
+    RUN_CHUNK_ROWS = int(os.environ.get("RUN_CHUNK_ROWS") or 4096)
+    RUN_CHUNK_COLUMNS = int(os.environ.get("RUN_CHUNK_COLUMNS") or 1)
+    RUN_CACHE_BYTES = int(os.environ.get("RUN_CACHE_BYTES") or 256 * 1024 * 1024)
+    RUN_CACHE_FILES = int(os.environ.get("RUN_CACHE_FILES") or 32)
+    TESTING_SCHEMA_TTL = float(os.environ.get("TESTING_SCHEMA_TTL") or 60)
+    TESTING_QUERY_THREADS = int(os.environ.get("TESTING_QUERY_THREADS") or 4)
     DBC = os.environ.get("DBC")
+    IMPORT_PROCESSES = int(os.environ.get("IMPORT_PROCESSES") or os.cpu_count() or 1)
+    IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE") or 64 * 1024 * 1024)
     CELERY_BROKER_URL = os.environ.get("REDIS_URL") or 'redis://localhost:6379'
     CELERY_RESULT_BACKEND = os.environ.get("REDIS_URL") or 'redis://localhost:6379'
     REDIS_URL = os.environ.get("REDIS_URL") or 'redis://localhost:6379'
+    RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL") or 7 * 24 * 3600)
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES") or 32 * 1024 * 1024)
+    EXPORT_QUEUE = os.environ.get("EXPORT_QUEUE") or "celery"
+    EXPORT_TTL = int(os.environ.get("EXPORT_TTL") or 24 * 3600)
@@ -1,8 +1,20 @@
 import datetime
+import glob
 import os
-from typing import List
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 import logging
 
+try:
+    import fcntl
+except ImportError:  # Windows, downloads are then only de-duplicated within a process
+    fcntl = None
+
 import boto3
 import h5py
 import numpy as np
@@ -14,34 +26,332 @@ from dataviewerapi import app
 logger = logging.getLogger(__name__)
 
 
+def s3_client():
+    return boto3.client("s3", endpoint_url=app.config["S3_ENDPOINT_URL"])
+
+
+_download_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock on a file shared by all processes, held while the block runs
+    """
+    lock_file = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.lock")
+    with open(lock_file, "w") as f:
+        if fcntl is None:
+            with _download_lock:
+                yield
+            return
+        # poll rather than block, so other greenlets of a gevent worker keep running while we wait
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def make_room(size: int):
+    """
+    Evict the least recently used data files until there's space for size more bytes under DATA_CACHE_BYTES. Only
+    files that are safely in the data bucket are removed
+    """
+    limit = app.config["DATA_CACHE_BYTES"]
+    if not limit:
+        return
+    files = []
+    for path in glob.glob(os.path.join(app.config["DATA_FOLDER"], "*.h5")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_atime, path, stat.st_size))
+    total = sum(f[2] for f in files)
+    s3 = s3_client()
+    for _, path, file_size in sorted(files):
+        if total + size <= limit:
+            break
+        try:
+            backed_up = s3.head_object(Bucket=app.config["DATA_BUCKET"],
+                                       Key=os.path.basename(path))["ContentLength"] == file_size
+        except ClientError:
+            backed_up = False
+        if not backed_up:
+            continue
+        try:
+            os.remove(path)
+            logger.info(f"Evicted {path} from the data cache")
+        except FileNotFoundError:
+            pass
+        total -= file_size
+
+
 def resolve_data_file(run_id: int):
     input_file = os.path.join(app.config["DATA_FOLDER"], f"{run_id}.h5")
-    if not os.path.exists(input_file):
-        # try downloading the file
-        if app.config["DATA_BUCKET"] is not None:
+    if os.path.exists(input_file):
+        # mark as recently used for the data cache, keeping the modification time
+        try:
+            os.utime(input_file, ns=(time.time_ns(), os.stat(input_file).st_mtime_ns))
+        except FileNotFoundError:
+            pass
+        else:
+            return input_file
+    if app.config["DATA_BUCKET"] is None:
+        logger.error(f"Can't find data {input_file}")
+        raise ValueError()
+    # only one process downloads a file, the rest wait for it to appear
+    with file_lock(input_file):
+        if not os.path.exists(input_file):
             logger.info(f"Retrieving {run_id}.h5...")
+            s3 = s3_client()
+            part = None
             try:
-                boto3.client("s3").download_file(app.config["DATA_BUCKET"], f"{run_id}.h5", input_file)
+                head = s3.head_object(Bucket=app.config["DATA_BUCKET"], Key=f"{run_id}.h5")
+                make_room(head["ContentLength"])
+                fd, part = tempfile.mkstemp(suffix=".part", dir=app.config["DATA_FOLDER"])
+                os.close(fd)
+                s3.download_file(app.config["DATA_BUCKET"], f"{run_id}.h5", part)
+                os.replace(part, input_file)
             except ClientError as e:
                 logger.error(e)
                 raise
-        else:
-            logger.error(f"Can't find data {input_file}")
-            raise ValueError()
+            finally:
+                if part is not None and os.path.exists(part):
+                    os.remove(part)
     return input_file
 
 
+def prefetch_runs(count: int):
+    """
+    Download the data files of the most recent runs ahead of time
+    """
+    from dataviewerapi import models
+    runs = models.Run.query.filter(models.Run.start.isnot(None)).order_by(models.Run.start.desc()).limit(count).all()
+    for run in runs:
+        try:
+            resolve_data_file(run.id)
+        except Exception as e:
+            logger.warning(f"Couldn't prefetch run {run.id}: {e}")
+
+
+_prefetch_started = False
+
+
+def start_prefetch():
+    """
+    Prefetch the DATA_PREFETCH_RUNS most recent runs in the background, once per process
+    """
+    global _prefetch_started
+    if _prefetch_started or not app.config["DATA_PREFETCH_RUNS"] or app.config["DATA_BUCKET"] is None:
+        return
+    _prefetch_started = True
+
+    def prefetch():
+        with app.app_context():
+            prefetch_runs(app.config["DATA_PREFETCH_RUNS"])
+    threading.Thread(target=prefetch, daemon=True).start()
+
+
+def lttb(timestamps: np.ndarray, values: np.ndarray, n: int) -> np.ndarray:
+    """
+    Pick n points of a series that keep its visual shape, using Largest-Triangle-Three-Buckets. The first and last
+    points are always kept, and the rest are split into n - 2 buckets. From each bucket, the point forming the largest
+    triangle with the point picked before it and the average of the next bucket is kept.
+    :return: indices of the picked points, in order
+    """
+    length = timestamps.shape[0]
+    if n >= length:
+        return np.arange(length)
+    if n < 3:
+        return np.unique(np.linspace(0, length - 1, max(n, 0)).astype(np.int64))
+    x = (timestamps - timestamps[0]).astype(np.float64)
+    y = values.astype(np.float64)
+
+    # bucket i holds points edges[i] up to edges[i + 1]
+    edges = np.linspace(1, length - 1, n - 1).astype(np.int64)
+    # average of the bucket after each bucket, which is just the last point for the final bucket
+    cx = np.concatenate(([0], np.cumsum(x)))
+    cy = np.concatenate(([0], np.cumsum(y)))
+    sizes = edges[2:] - edges[1:-1]
+    avg_x = np.append((cx[edges[2:]] - cx[edges[1:-1]]) / sizes, x[-1])
+    avg_y = np.append((cy[edges[2:]] - cy[edges[1:-1]]) / sizes, y[-1])
+
+    picked = np.empty(n, dtype=np.int64)
+    picked[0] = a = 0
+    picked[-1] = length - 1
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - avg_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y[i] - y[a]))
+        a = lo + int(np.argmax(area))
+        picked[i + 1] = a
+    return picked
+
+
+def to_ms(time: datetime.datetime) -> float:
+    """
+    Milliseconds since the epoch, treating naive times as UTC like the database does
+    """
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return time.timestamp() * 1000
+
+
+def search(dataset, value, side="left", lo=0, hi=None, column=None) -> int:
+    """
+    np.searchsorted on a sorted dataset (or one column of it) between rows lo and hi, reading only the elements the
+    binary search visits rather than the whole dataset
+    """
+    hi = dataset.shape[0] if hi is None else hi
+    step = dataset.chunks[0] if dataset.chunks is not None else 4096
+    while hi - lo > step:
+        mid = (lo + hi) // 2
+        v = dataset[mid] if column is None else dataset[mid, column]
+        if v < value or (side == "right" and v == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    # finish within about one chunk with a single read
+    rest = dataset[lo:hi] if column is None else dataset[lo:hi, column]
+    return lo + int(np.searchsorted(rest, value, side=side))
+
+
+@dataclass
+class OpenFile:
+    db: h5py.File
+    mtime: int
+    # requests currently reading the file, it's only closed once they're done
+    users: int = 0
+    cached: bool = True
+    # column of each variable, by id, once looked up
+    columns: Optional[Dict[int, int]] = None
+
+
+class RunCache:
+    """
+    Per process cache of open run files, and of arrays read from them.
+
+    Arrays are keyed by file and modification time, so a rewritten file is never served stale. Least recently used
+    arrays are evicted once their total size passes max_bytes, and least recently used files once more than max_files
+    are open.
+    """
+
+    def __init__(self, max_bytes: int, max_files: int):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.arrays = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def open(self, filename: str) -> OpenFile:
+        mtime = os.stat(filename).st_mtime_ns
+        with self.lock:
+            entry = self.files.pop(filename, None)
+            if entry is not None and entry.mtime != mtime:
+                self.discard(entry)
+                entry = None
+            if entry is None:
+                entry = OpenFile(h5py.File(filename, "r"), mtime)
+            entry.users += 1
+            self.files[filename] = entry
+            # close the least recently used files that aren't being read
+            idle = [name for name, f in self.files.items() if f.users == 0]
+            for name in idle[:max(len(self.files) - self.max_files, 0)]:
+                self.discard(self.files.pop(name))
+        return entry
+
+    def release(self, entry: OpenFile):
+        with self.lock:
+            entry.users -= 1
+            if not entry.cached and entry.users == 0:
+                entry.db.close()
+
+    def discard(self, entry: OpenFile):
+        entry.cached = False
+        if entry.users == 0:
+            entry.db.close()
+
+    def get(self, key):
+        with self.lock:
+            arrays = self.arrays.get(key)
+            if arrays is None:
+                self.misses += 1
+                return None
+            self.arrays.move_to_end(key)
+            self.hits += 1
+            return arrays
+
+    def put(self, key, arrays):
+        size = sum(a.nbytes for a in arrays)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.arrays:
+                return
+            self.arrays[key] = arrays
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.arrays.popitem(last=False)
+                self.bytes -= sum(a.nbytes for a in evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.arrays),
+                    "bytes": self.bytes, "max_bytes": self.max_bytes, "open_files": len(self.files)}
+
+
+_run_cache = None
+
+
+def run_cache() -> RunCache:
+    global _run_cache
+    if _run_cache is None:
+        _run_cache = RunCache(app.config["RUN_CACHE_BYTES"], app.config["RUN_CACHE_FILES"])
+    return _run_cache
+
+
 class RunDataPoints:
-    def __init__(self, run_id):
+    """
+    Reads a converted run file, in either the dense (one block for all variables) or the sparse (one series per
+    variable) layout. If given a start and end time, only the part of the run within that window is read.
+
+    Read only files are shared through the process wide run cache, which also keeps whole arrays that have been read,
+    unless cached is False
+    """
+
+    def __init__(self, run_id, filename: str = None, mode="r", start: datetime.datetime = None,
+                 end: datetime.datetime = None, cached=True):
         self.run_id = run_id
-        self.filename = resolve_data_file(self.run_id)
+        self.filename = filename or resolve_data_file(self.run_id)
+        self.mode = mode
+        self.start = None if start is None else to_ms(start)
+        self.end = None if end is None else to_ms(end)
+        self.cached = cached and mode == "r"
+        self.entry = None
 
     def __enter__(self):
-        self.db = h5py.File(self.filename, "r")
+        if self.cached:
+            self.entry = run_cache().open(self.filename)
+            self.db = self.entry.db
+        else:
+            self.db = h5py.File(self.filename, self.mode)
+        self.layout = self.db.attrs.get("layout", "dense")
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.db.close()
+        if self.entry is not None:
+            run_cache().release(self.entry)
+            self.entry = None
+        else:
+            self.db.close()
 
     def last_modified(self):
         stat = os.stat(self.filename)
@@ -55,27 +365,229 @@ class RunDataPoints:
     def names(self):
         return self.db["variables"]["names"][:]
 
-    def times(self):
-        refs = self.db["timestamps"][:]
-        for ts in refs:
-            yield datetime.datetime.fromtimestamp(ts / 1000, datetime.timezone.utc)
+    def columns(self) -> Dict[int, int]:
+        """
+        Column of each variable in the file, by id. Looked up once per cached file
+        """
+        if self.entry is not None and self.entry.columns is not None:
+            return self.entry.columns
+        columns = {vid: col for col, vid in enumerate(self.variables())}
+        if self.entry is not None:
+            self.entry.columns = columns
+        return columns
 
-    def read(self, variable_ids: List[int]):
-        vids = self.variables()
-        cols = []
-        for vid in variable_ids:
-            try:
-                cols.append(vids.index(vid))
-            except ValueError:
-                # this run doesn't contain this variable
-                cols.append("BAD")
-
-        data = []
-        for col in cols:
-            if col == "BAD":
-                data.append(np.full((self.db["data"].shape[0],), np.nan))
+    def rows(self, timestamps, lo=0, hi=None, column=None, before=0) -> slice:
+        """
+        Rows of a sorted timestamps dataset (between lo and hi) that fall within the window
+        :param before: also include rows up to this many ms before the window starts
+        """
+        hi = timestamps.shape[0] if hi is None else hi
+        if self.start is not None:
+            lo = search(timestamps, self.start - before, "left", lo, hi, column)
+        if self.end is not None:
+            hi = search(timestamps, self.end, "right", lo, hi, column)
+        return slice(lo, hi)
+
+    def window(self, key, timestamps, read, lo=0, hi=None, column=None, before=0):
+        """
+        Read arrays of rows within the window. When caching, whole arrays are read and kept if they're already cached,
+        or if the window covers at least half of them anyway. Otherwise only the window's rows are read
+        :param key: what's being read, identifying it in the cache along with the file
+        :param timestamps: sorted dataset the window is found in
+        :param read: reads the arrays (the first one being times) for a slice of rows
+        :return: the arrays within the window
+        """
+        if self.entry is None:
+            return read(self.rows(timestamps, lo, hi, column, before))
+        key = (self.filename, self.entry.mtime) + key
+        arrays = run_cache().get(key)
+        if arrays is None:
+            rows = self.rows(timestamps, lo, hi, column, before)
+            whole = slice(lo, timestamps.shape[0] if hi is None else hi)
+            if 2 * (rows.stop - rows.start) < whole.stop - whole.start:
+                return read(rows)
+            arrays = read(whole)
+            run_cache().put(key, arrays)
+        times = arrays[0]
+        first = 0 if self.start is None else int(np.searchsorted(times, self.start - before, side="left"))
+        last = len(times) if self.end is None else int(np.searchsorted(times, self.end, side="right"))
+        return tuple(a[first:last] for a in arrays)
+
+    def timestamps(self) -> np.ndarray:
+        """
+        Every time point in the run, in milliseconds since the epoch
+        """
+        if self.layout == "sparse":
+            return np.unique(np.concatenate([np.zeros((0,), dtype=np.int64)] +
+                                            [self.series(vid)[0] for vid in self.variables()]))
+        timestamps = self.db["timestamps"]
+        return self.window(("timestamps",), timestamps, lambda rows: (timestamps[rows],))[0]
+
+    def times(self) -> np.ndarray:
+        return self.timestamps().astype("datetime64[ms]")
+
+    def series(self, variable_id: int):
+        """
+        Time points and values of a single variable, without gaps
+        :return: (timestamps, values), or None if this run doesn't contain this variable
+        """
+        col = self.columns().get(variable_id)
+        if col is None:
+            return None
+        if self.layout == "sparse":
+            group = self.db["series"][str(variable_id)]
+            return self.window(("series", variable_id), group["timestamps"],
+                               lambda rows: (group["timestamps"][rows], group["values"][rows]))
+
+        def read(rows):
+            values = self.db["data"][rows, col]
+            sent = ~np.isnan(values)
+            return self.db["timestamps"][rows][sent], values[sent]
+        return self.window(("series", variable_id), self.db["timestamps"], read)
+
+    def variable_stats(self) -> List[dict]:
+        """
+        Number of points and first/last time of each variable in the run, ignoring any window
+        :return: list of {"id", "samples", "start", "end"}, times in ms since the epoch (None without points)
+        """
+        stats = []
+        if self.layout != "sparse":
+            all_timestamps = self.db["timestamps"][:]
+        for col, vid in enumerate(self.variables()):
+            if self.layout == "sparse":
+                timestamps = self.db["series"][str(vid)]["timestamps"]
             else:
-                data.append(self.db["data"][:, col])
-        # data = self.db["data"][:, cols]
-        data = np.array(data).transpose()
+                timestamps = all_timestamps[~np.isnan(self.db["data"][:, col])]
+            samples = timestamps.shape[0]
+            stats.append({"id": vid, "samples": samples, "start": int(timestamps[0]) if samples > 0 else None,
+                          "end": int(timestamps[samples - 1]) if samples > 0 else None})
+        return stats
+
+    def select(self, variable_ids: List[int]):
+        """
+        Read the given variables aligned to the time points where at least one of them has data (dense files return
+        every time point)
+        :return: (timestamps, data) where data has one column per requested variable, NaN where there is no value
+        """
+        series = [self.series(vid) for vid in variable_ids]
+        if self.layout != "sparse":
+            timestamps = self.timestamps()
+            return timestamps, self.align(timestamps, series)
+        return self.merge(series)
+
+    @staticmethod
+    def align(timestamps: np.ndarray, series) -> np.ndarray:
+        data = np.full((timestamps.shape[0], len(series)), np.nan)
+        for col, s in enumerate(series):
+            if s is not None:
+                data[np.searchsorted(timestamps, s[0]), col] = s[1]
         return data
+
+    def levels(self) -> List[int]:
+        """
+        Bucket widths (ms) of the downsampled levels stored in this file, finest first
+        """
+        if "levels" not in self.db:
+            return []
+        return sorted(int(width) for width in self.db["levels"].keys())
+
+    def level_for(self, width: float) -> Optional[int]:
+        """
+        The coarsest stored level whose buckets are no wider than width, or None if full resolution is needed
+        """
+        levels = [level for level in self.levels() if level <= width]
+        return levels[-1] if len(levels) > 0 else None
+
+    def summary(self, variable_id: int, level: int):
+        """
+        Buckets of a single variable at a downsampled level. Variables with too few points to be worth downsampling at
+        this level are returned at full resolution, as buckets of one point each
+        :return: (timestamps, min, max, mean, count), or None if this run doesn't contain this variable
+        """
+        col = self.columns().get(variable_id)
+        if col is None:
+            return None
+        group = self.db["levels"][str(level)]
+        lo, hi = group["offsets"][col:col + 2]
+        if hi > lo:
+            def read(rows):
+                buckets = group["buckets"][rows, :]
+                return (buckets[:, 0].astype(np.int64),) + tuple(buckets[:, i] for i in range(1, 5))
+            # include the bucket the window starts in
+            return self.window(("level", level, variable_id), group["buckets"], read, int(lo), int(hi), column=0,
+                               before=level - 1)
+        timestamps, values = self.series(variable_id)
+        return timestamps, values, values, values, np.ones(values.shape)
+
+    def stored_filter(self, filter_id: int, expression: str):
+        """
+        The group holding a materialized filter, or None if it isn't stored or was computed from another expression
+        """
+        group = self.db.get(f"filters/{filter_id}")
+        if group is None or group.attrs.get("expression") != expression:
+            return None
+        return group
+
+    def filter_series(self, filter_id: int, expression: str):
+        """
+        Stored time points and values of a materialized filter
+        :return: (timestamps, values), or None if the filter isn't stored for its current expression
+        """
+        group = self.stored_filter(filter_id, expression)
+        if group is None:
+            return None
+        return self.window(("filter", filter_id), group["timestamps"],
+                          lambda rows: (group["timestamps"][rows], group["values"][rows]))
+
+    def filter_summary(self, filter_id: int, expression: str, level: int):
+        """
+        Stored buckets of a materialized filter at a downsampled level, like summary
+        :return: (timestamps, min, max, mean, count), or None if the filter isn't stored for its current expression
+        """
+        group = self.stored_filter(filter_id, expression)
+        if group is None:
+            return None
+        if f"levels/{level}" in group:
+            buckets = group["levels"][str(level)]
+
+            def read(rows):
+                b = buckets[rows, :]
+                return (b[:, 0].astype(np.int64),) + tuple(b[:, i] for i in range(1, 5))
+            return self.window(("filter level", level, filter_id), buckets, read, column=0, before=level - 1)
+        timestamps, values = self.filter_series(filter_id, expression)
+        return timestamps, values, values, values, np.ones(values.shape)
+
+    def select_summary(self, variable_ids: List[int], level: int):
+        """
+        Read the given variables at a downsampled level, aligned to the bucket times of any of them
+        :return: (timestamps, min, max, mean), each with one column per requested variable
+        """
+        return self.merge_summaries([self.summary(vid, level) for vid in variable_ids])
+
+    @staticmethod
+    def merge(series: List[Optional[Tuple[np.ndarray, np.ndarray]]]):
+        """
+        Align series to the time points where at least one of them has data
+        :param series: (timestamps, values) of each column, or None for a column without data
+        :return: (timestamps, data) where data has one column per series, NaN where there is no value
+        """
+        timestamps = np.unique(np.concatenate([np.zeros((0,), dtype=np.int64)] +
+                                              [s[0] for s in series if s is not None]))
+        return timestamps, RunDataPoints.align(timestamps, series)
+
+    @staticmethod
+    def merge_summaries(summaries: List[Optional[tuple]]):
+        """
+        Align buckets of several columns, as returned by summary, to the bucket times of any of them
+        :return: (timestamps, min, max, mean), each with one column per summary
+        """
+        timestamps = np.unique(np.concatenate([np.zeros((0,), dtype=np.int64)] +
+                                              [s[0] for s in summaries if s is not None]))
+        return (timestamps,) + tuple(RunDataPoints.align(timestamps, [None if s is None else (s[0], s[stat])
+                                                                      for s in summaries]) for stat in (1, 2, 3))
+
+    def read(self, variable_ids: List[int]):
+        """
+        Read the given variables aligned to every time point in the run, NaN where there is no value
+        """
+        return self.align(self.timestamps(), [self.series(vid) for vid in variable_ids])
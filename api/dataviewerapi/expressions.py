@@ -0,0 +1,53 @@
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sympy import Symbol, lambdify, sympify
+
+
+@lru_cache(maxsize=256)
+def compile_expression(expression: str):
+    """
+    Compile a filter expression into a NumPy function, once per expression text
+    :return: (function, names of the variables it takes as arguments, in order)
+    """
+    expr = sympify(expression)
+    names = sorted(symbol.name for symbol in expr.free_symbols)
+    return lambdify([Symbol(name) for name in names], expr, modules="numpy"), names
+
+
+def expression_variables(expression: str) -> List[str]:
+    return compile_expression(expression)[1]
+
+
+def hold(data: np.ndarray) -> np.ndarray:
+    """
+    Fill each NaN with the last value before it in the same column
+    """
+    rows = np.where(np.isnan(data), 0, np.arange(data.shape[0])[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return data[rows, np.arange(data.shape[1])]
+
+
+def evaluate(expression: str, inputs: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Evaluate an expression over whole series at once. Its value is computed at every time point of any of its inputs,
+    holding each input at its last value, from when all of them have one
+    :param inputs: (timestamps, values) of each variable in the expression, by name
+    :return: (timestamps, values), or None if an input is missing
+    """
+    function, names = compile_expression(expression)
+    if any(inputs.get(name) is None for name in names):
+        return None
+    series = [inputs[name] for name in names]
+    timestamps = np.unique(np.concatenate([np.zeros((0,), dtype=np.int64)] + [s[0] for s in series]))
+    data = np.full((timestamps.shape[0], len(series)), np.nan)
+    for col, (ts, values) in enumerate(series):
+        data[np.searchsorted(timestamps, ts), col] = values
+    data = hold(data)
+    with np.errstate(all="ignore"):
+        values = function(*data.T)
+    # constant expressions give a single value
+    values = np.broadcast_to(np.asarray(values, dtype=np.float64), timestamps.shape)
+    valid = ~np.isnan(values)
+    return timestamps[valid], values[valid]
@@ -1 +1,3 @@
-from .run import import_run
\ No newline at end of file
+from .run import import_run
+from .filters import materialize_filter
+from .export import export_interval_data
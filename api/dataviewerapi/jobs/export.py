@@ -0,0 +1,114 @@
+import datetime
+import gzip
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from dataviewerapi import app, celery
+from dataviewerapi.data import file_lock, s3_client
+from dataviewerapi.routes.testingday import OutputModes, load_and_emit_data, load_and_emit_frames
+
+logger = logging.getLogger(__name__)
+
+# file extension of each export format
+EXPORT_FORMATS = {"csv": "csv.gz", "bin": "bin.gz"}
+# seconds between progress reports
+PROGRESS_INTERVAL = 1
+
+
+def export_folder() -> str:
+    folder = os.path.join(app.config["DATA_FOLDER"], "exports")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def export_file_name(export_id: str, fmt: str) -> str:
+    return f"{export_id}.{EXPORT_FORMATS[fmt]}"
+
+
+def resolve_export_file(name: str) -> str:
+    """
+    Local path of a finished export, downloaded from DATA_BUCKET if needed
+    :raise FileNotFoundError: if there's no such export
+    """
+    output_file = os.path.join(export_folder(), name)
+    if os.path.exists(output_file) or app.config["DATA_BUCKET"] is None:
+        if not os.path.exists(output_file):
+            raise FileNotFoundError(output_file)
+        return output_file
+    with file_lock(output_file):
+        if not os.path.exists(output_file):
+            logger.info(f"Retrieving exports/{name}...")
+            part = f"{output_file}.part"
+            try:
+                s3_client().download_file(app.config["DATA_BUCKET"], f"exports/{name}", part)
+                os.replace(part, output_file)
+            except ClientError as e:
+                logger.warning(e)
+                raise FileNotFoundError(output_file)
+            finally:
+                if os.path.exists(part):
+                    os.remove(part)
+    return output_file
+
+
+def remove_expired_exports():
+    """
+    Delete local export files older than EXPORT_TTL
+    """
+    oldest = time.time() - app.config["EXPORT_TTL"]
+    folder = export_folder()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if not name.startswith(".") and os.stat(path).st_mtime < oldest:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+@celery.task(bind=True)
+def export_interval_data(self, query: str, columns, epoch: str, fmt: str, bounds):
+    """
+    Write the results of a testing day query to a gzip compressed file in the exports folder (and DATA_BUCKET), as
+    CSV or framed binary columns
+    :param query: selects the index column followed by the given columns, as built for the data endpoint
+    :param epoch: ISO time of index 0
+    :param bounds: (first, last) index the query reads, to report progress
+    """
+    self.update_state(state='PROGRESS', meta={'status': 1, 'progress': 0})
+    remove_expired_exports()
+    start, end = bounds
+    reported = time.monotonic()
+
+    def report(index: int):
+        nonlocal reported
+        if time.monotonic() - reported >= PROGRESS_INTERVAL:
+            reported = time.monotonic()
+            self.update_state(state='PROGRESS', meta={'status': 1, 'progress': (index - start) / max(end - start, 1)})
+
+    epoch = datetime.datetime.fromisoformat(epoch)
+    name = export_file_name(self.request.id, fmt)
+    output_file = os.path.join(export_folder(), name)
+    part = f"{output_file}.part"
+    try:
+        if fmt == "bin":
+            body = load_and_emit_frames(query, columns, epoch, report)
+        else:
+            body = load_and_emit_data(query, OutputModes.CSV, columns, epoch, report)
+        with gzip.open(part, "wb", compresslevel=6) as f:
+            for chunk in body:
+                f.write(chunk.encode() if isinstance(chunk, str) else chunk)
+        os.replace(part, output_file)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    if app.config["DATA_BUCKET"] is not None:
+        try:
+            s3_client().upload_file(output_file, app.config["DATA_BUCKET"], f"exports/{name}")
+        except ClientError:
+            logger.warning(f"Failed to upload export {output_file}")
+    logger.info(f"Exported {name}")
+    return {'status': 10, 'progress': 1, 'file': name, 'size': os.path.getsize(output_file)}
@@ -0,0 +1,43 @@
+import logging
+import os
+import shutil
+from typing import List
+
+from dataviewerapi import celery
+from dataviewerapi.data import file_lock, resolve_data_file
+from dataviewerapi.jobs.run import backup_output_file, storage_options, write_filter
+
+logger = logging.getLogger(__name__)
+
+
+@celery.task(bind=True)
+def materialize_filter(self, f, all_variables, run_ids: List[int]):
+    """
+    Store a filter's values in the data files of the given runs, replacing any computed from an older expression
+    :param f: the filter, as serialized by the filters endpoint
+    """
+    options = storage_options()
+    names = {v["name"]: v["id"] for v in all_variables}
+    for i, run_id in enumerate(run_ids):
+        self.update_state(state='PROGRESS', meta={'status': 1, 'progress': i / max(len(run_ids), 1)})
+        try:
+            run_file = resolve_data_file(run_id)
+        except Exception:
+            logger.warning(f"Skipping run {run_id}, its data file isn't available")
+            continue
+        # edit a copy and swap it in, so readers (which may hold the file open) never see a partial file
+        tmp_file = f"{run_file}.filter"
+        with file_lock(run_file):
+            try:
+                shutil.copyfile(run_file, tmp_file)
+                changed = write_filter(tmp_file, f["id"], f["expression"], names, options["codec"],
+                                       options["block_rows"])
+                if changed:
+                    os.replace(tmp_file, run_file)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        if changed:
+            backup_output_file(run_id)
+            logger.info(f"Stored filter {f['name']} in run {run_id}")
+    return {'status': 10, 'progress': 1}
@@ -1,25 +1,83 @@
-import csv
 import datetime
 import os
-from dataclasses import dataclass
-from typing import List
 import logging
-import multiprocessing
+import tempfile
+from dataclasses import dataclass
+from typing import Dict, Optional
 
-import boto3
 import h5py
 import cantools.database
 import numpy as np
+import pandas as pd
+from billiard.pool import Pool
 from botocore.exceptions import ClientError
 
+from canparser import DecodedBlock, Message, open_log, timezone
 from dataviewerapi import app, celery
+from dataviewerapi.data import RunDataPoints, s3_client
+from dataviewerapi.expressions import evaluate, expression_variables
 
 logger = logging.getLogger(__name__)
 
-# Make sure this is whatever the car uses
-timezone = datetime.timezone(-datetime.timedelta(hours=5), "Central Daylight Time")
-EXTENDED_MASK = 0x1FFFFFFF
-STANDARD_MASK = 0x7FF
+# rows per block when reading back pieces of a parallel import
+PARTIAL_BLOCK_ROWS = 100000
+RUN_LAYOUTS = ("dense", "sparse")
+# downsampled levels stored in run files: bucket widths in ms, each LEVEL_FACTOR times wider than the last
+LEVEL_BASE = 100
+LEVEL_FACTOR = 4
+LEVEL_COUNT = 8
+
+
+@dataclass
+class Codec:
+    """
+    Compression filters applied to run file datasets, written as "none", "lzf", "gzip" or "gzip:<level>", with an
+    optional "+shuffle" suffix
+    """
+    compression: Optional[str] = "gzip"
+    level: Optional[int] = None
+    shuffle: bool = False
+
+    @classmethod
+    def parse(cls, spec: str) -> "Codec":
+        name, _, flags = spec.strip().lower().partition("+")
+        if flags not in ("", "shuffle"):
+            raise ValueError(f"Unknown codec option {flags}")
+        name, _, level = name.partition(":")
+        if name == "none":
+            if level or flags:
+                raise ValueError("Uncompressed datasets take no options")
+            return cls(None)
+        if name not in ("gzip", "lzf"):
+            raise ValueError(f"Unknown codec {name}")
+        if level and name != "gzip":
+            raise ValueError(f"{name} doesn't take a level")
+        return cls(name, int(level) if level else None, flags == "shuffle")
+
+    def options(self, shuffle=None) -> dict:
+        """
+        Keyword arguments for h5py's create_dataset
+        :param shuffle: override whether the shuffle filter is used. Timestamps are always shuffled, which groups their
+        slowly changing high bytes together and compresses much better
+        """
+        if self.compression is None:
+            return {}
+        return {"compression": self.compression, "compression_opts": self.level,
+                "shuffle": self.shuffle if shuffle is None else shuffle}
+
+    def __str__(self):
+        if self.compression is None:
+            return "none"
+        return self.compression + (f":{self.level}" if self.level is not None else "") + \
+            ("+shuffle" if self.shuffle else "")
+
+
+def storage_options() -> dict:
+    """
+    DataWriter arguments for new run files, from the app config
+    """
+    return {"layout": app.config["RUN_LAYOUT"], "codec": Codec.parse(app.config["RUN_CODEC"]),
+            "block_rows": app.config["RUN_CHUNK_ROWS"], "block_columns": app.config["RUN_CHUNK_COLUMNS"]}
 
 
 def resolve_input_file(run_id: int):
@@ -29,7 +87,7 @@ def resolve_input_file(run_id: int):
         if app.config["UPLOAD_BUCKET"] is not None:
             logger.info(f"Retrieving {run_id}.csv...")
             try:
-                boto3.client("s3").download_file(app.config["UPLOAD_BUCKET"], f"{run_id}.csv", input_file)
+                s3_client().download_file(app.config["UPLOAD_BUCKET"], f"{run_id}.csv", input_file)
             except ClientError as e:
                 logger.error(e)
                 raise
@@ -43,221 +101,501 @@ def backup_output_file(run_id: int):
     output_file = os.path.join(app.config["DATA_FOLDER"], f"{run_id}.h5")
     if app.config["DATA_BUCKET"] is not None:
         try:
-            boto3.client("s3").upload_file(output_file, app.config["DATA_BUCKET"], f"{run_id}.h5")
+            s3_client().upload_file(output_file, app.config["DATA_BUCKET"], f"{run_id}.h5")
         except ClientError as e:
             logger.warning(f"Failed to upload result {output_file}")
 
 
-def load_timestamps_variables(parser, all_variables):
-    total_msg = 0
-    uniq_sig = set()
-    timestamps = set()
-    try:
-        for msg in parser.messages():
-            total_msg += 1
-            for s in msg.signals:
-                uniq_sig.add(s.sig_name)
-            timestamps.add(msg.timestamp)
-    except ValueError:  # bad input format
-        return {'status': 9, 'progress': 0}
+def import_chunk(dbc_file: str, input_file: str, byte_range, all_variables, partial_file: str):
+    """
+    Decode one piece of a log into its own (uncompressed) run file. Runs in a worker process
+    :return: whether the piece was read to the end, rather than stopping at a malformed row
+    """
+    parser = open_log(dbc_file, input_file)
+    with DataWriter(partial_file, all_variables, codec=Codec(None), layout="dense") as writer:
+        for block in parser.blocks(byte_range=byte_range):
+            writer.write_block(block)
+    return parser.complete
+
 
-    variables = list(filter(lambda v: v["name"] in uniq_sig, all_variables))
-    times = sorted(list(timestamps))
-    return times, variables
+def _import_chunk(args):
+    return import_chunk(*args)
+
+
+def run_file_blocks(run_file: str, block_rows=PARTIAL_BLOCK_ROWS):
+    """
+    Read a run file (of either layout) back as decoded blocks, in time order
+    """
+    with h5py.File(run_file, "r") as f:
+        names = [n.decode() for n in f["variables/names"][:]]
+        if f.attrs.get("layout", "dense") == "sparse":
+            yield from sparse_file_blocks(f, names, block_rows)
+            return
+        R = f["timestamps"].shape[0]
+        for start in range(0, R, block_rows):
+            data = f["data"][start:start + block_rows, :]
+            yield DecodedBlock(f["timestamps"][start:start + block_rows],
+                               {name: data[:, col] for col, name in enumerate(names)})
+
+
+def sparse_file_blocks(f: h5py.File, names, block_rows: int):
+    series = [(name, f[f"series/{vid}/timestamps"][:], f[f"series/{vid}/values"])
+              for name, vid in zip(names, f["variables/ids"][:])]
+    timestamps = np.unique(np.concatenate([np.zeros((0,), dtype=np.int64)] + [ts for _, ts, _ in series]))
+    for start in range(0, timestamps.shape[0], block_rows):
+        times = timestamps[start:start + block_rows]
+        columns = {}
+        for name, ts, values in series:
+            lo = int(np.searchsorted(ts, times[0], side="left"))
+            hi = int(np.searchsorted(ts, times[-1], side="right"))
+            column = np.full(times.shape, np.nan)
+            column[np.searchsorted(times, ts[lo:hi])] = values[lo:hi]
+            columns[name] = column
+        yield DecodedBlock(times, columns)
+
+
+def rewrite_run_file(run_file: str, out_file: str, **options) -> "DataWriter":
+    """
+    Copy a run file into a new file with different storage settings
+
+    :param options: DataWriter arguments (layout, codec, block_rows, block_columns)
+    :return: the finished writer
+    """
+    with h5py.File(run_file, "r") as f:
+        variables = [{"name": n.decode(), "id": int(i)} for n, i in zip(f["variables/names"][:], f["variables/ids"][:])]
+    with DataWriter(out_file, variables, **options) as writer:
+        for block in run_file_blocks(run_file):
+            writer.write_block(block)
+    write_levels(out_file, options.get("codec"), options.get("block_rows", 1000))
+    with h5py.File(run_file, "r") as src, h5py.File(out_file, "a") as dst:
+        # materialized filters are kept as they are
+        if "filters" in src:
+            src.copy("filters", dst)
+    return writer
+
+
+def downsample(timestamps, mins, maxs, means, counts, width: int):
+    """
+    Merge time ordered points or buckets into buckets of the given width
+    :return: (bucket start times, min, max, mean, count)
+    """
+    buckets = timestamps // width
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+    total = np.add.reduceat(counts, starts)
+    return (buckets[starts] * width, np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts),
+            np.add.reduceat(means * counts, starts) / total, total)
+
+
+def write_levels(run_file: str, codec: Codec = None, block_rows=1000):
+    """
+    Add downsampled min/max/mean/count levels to a finished run file.
+
+    Each level is one ``levels/<width>/buckets`` table of (time, min, max, mean, count) rows, holding every variable's
+    buckets one after the other, with ``levels/<width>/offsets`` marking where each variable (in ``variables/ids``
+    order) starts. A variable is left out of levels that wouldn't be at least twice as small as its full series.
+    """
+    codec = codec or Codec()
+    widths = [LEVEL_BASE * LEVEL_FACTOR ** k for k in range(LEVEL_COUNT)]
+    with RunDataPoints(None, run_file, mode="a") as data:
+        vids = data.variables()
+        tables = {}
+        offsets = {width: [0] for width in widths}
+        for width in widths:
+            tables[width] = data.db.create_dataset(f"levels/{width}/buckets", (0, 5), maxshape=(None, 5),
+                                                   dtype=np.float64, chunks=(block_rows, 5), **codec.options())
+        for vid in vids:
+            timestamps, values = data.series(vid)
+            level = (timestamps, values, values, values, np.ones(values.shape))
+            for width in widths:
+                table = tables[width]
+                length = table.shape[0]
+                if timestamps.shape[0] > 0:
+                    level = downsample(*level, width)
+                    count = level[0].shape[0]
+                    if 2 * count <= timestamps.shape[0]:
+                        table.resize((length + count, 5))
+                        table[length:, :] = np.column_stack(level)
+                        length += count
+                offsets[width].append(length)
+        for width in widths:
+            data.db.create_dataset(f"levels/{width}/offsets", data=np.array(offsets[width], dtype=np.int64))
+
+
+def write_filter(run_file: str, filter_id: int, expression: str, variables: Dict[str, int], codec: Codec = None,
+                 block_rows=1000) -> bool:
+    """
+    Store the values of a filter in a run file as ``filters/<filter id>/timestamps`` and ``values``, along with
+    ``levels/<width>`` buckets at each of the file's downsampled levels (left out like in write_levels) and the
+    expression they were computed from. Values computed from an older expression are replaced
+    :param variables: ids of variables by name
+    :return: whether the file changed
+    """
+    codec = codec or Codec()
+    with RunDataPoints(None, run_file, mode="a") as data:
+        if data.stored_filter(filter_id, expression) is not None:
+            return False
+        names = expression_variables(expression)
+        result = evaluate(expression, {name: data.series(variables[name]) if name in variables else None
+                                       for name in names})
+        changed = f"filters/{filter_id}" in data.db
+        if changed:
+            del data.db[f"filters/{filter_id}"]
+        if result is None:
+            # the run doesn't have everything the filter needs
+            return changed
+        timestamps, values = result
+        group = data.db.create_group(f"filters/{filter_id}")
+        group.attrs["expression"] = expression
+        group.create_dataset("timestamps", data=timestamps, maxshape=(None,), chunks=(block_rows,),
+                             **codec.options(shuffle=True))
+        group.create_dataset("values", data=values, maxshape=(None,), chunks=(block_rows,), **codec.options())
+        level = (timestamps, values, values, values, np.ones(values.shape))
+        for width in data.levels():
+            if timestamps.shape[0] == 0:
+                break
+            level = downsample(*level, width)
+            if 2 * level[0].shape[0] <= timestamps.shape[0]:
+                group.create_dataset(f"levels/{width}", data=np.column_stack(level), maxshape=(None, 5),
+                                     chunks=(block_rows, 5), **codec.options())
+    return True
 
 
 @celery.task(bind=True)
-def import_run(self, run_id: int, all_variables):
+def import_run(self, run_id: int, all_variables, filters=()):
     dbc_file = app.config["DBC"]
     try:
         input_file = resolve_input_file(run_id)
     except:
         return {'status': 9, 'progress': 0}
 
-    parser = CANParser(dbc_file, input_file)
+    # raw datalogger logs are decoded with the DBC, already decoded logs are pivoted straight into the output
+    parser = open_log(dbc_file, input_file)
     self.update_state(state='PROGRESS', meta={'status': 1, 'progress': 0})
 
-    # first pass: tally total messages and signals
-    logging.info(f"Loading unique messages from {input_file}")
+    # single pass: decode each block of messages and append it to the output as we go
+    logging.info(f"Importing messages from {input_file}")
+    output_file = os.path.join(app.config["DATA_FOLDER"], f"{run_id}.h5")
+    size = max(os.path.getsize(input_file), 1)
     try:
-        timestamps, variables = load_timestamps_variables(parser, all_variables)
-    except:
+        ranges = parser.byte_ranges(app.config["IMPORT_CHUNK_SIZE"])
+        processes = min(app.config["IMPORT_PROCESSES"], len(ranges))
+        with DataWriter(output_file, all_variables, **storage_options()) as writer:
+            if processes <= 1:
+                for block in parser.blocks():
+                    writer.write_block(block)
+                    self.update_state(state='PROGRESS', meta={'status': 1, 'progress': parser.position / size})
+            else:
+                # decode pieces of the log in parallel, then append them in order
+                logging.info(f"Decoding {len(ranges)} pieces with {processes} processes")
+                with tempfile.TemporaryDirectory(dir=app.config["DATA_FOLDER"]) as tmp, Pool(processes) as pool:
+                    partials = [os.path.join(tmp, f"{i}.h5") for i in range(len(ranges))]
+                    args = [(dbc_file, input_file, r, all_variables, p) for r, p in zip(ranges, partials)]
+                    for i, complete in enumerate(pool.imap(_import_chunk, args)):
+                        for block in run_file_blocks(partials[i]):
+                            writer.write_block(block)
+                        os.remove(partials[i])
+                        self.update_state(state='PROGRESS', meta={'status': 1, 'progress': (i + 1) / len(ranges)})
+                        if not complete:
+                            # a sequential read would have stopped here too
+                            pool.terminate()
+                            break
+    except ValueError:  # bad input format
         return {'status': 9, 'progress': 0}
-    logging.info(f"Found {len(variables)} unique variables and {len(timestamps)} time points")
-    self.update_state(state='PROGRESS', meta={'status': 1, 'progress': 0})
-
-    # now actually store the data
-    output_file = os.path.join(app.config["DATA_FOLDER"], f"{run_id}.h5")
-    with DataWriter(output_file, variables, timestamps) as writer:
-        for i, msg in enumerate(parser.messages()):
-            writer.write_message(msg)
-
-            if i % 1000 == 0:
-                self.update_state(state='PROGRESS', meta={'status': 1, 'progress': i/len(timestamps)})
+    if writer.start is None:
+        logging.error(f"No messages could be decoded from {input_file}")
+        return {'status': 9, 'progress': 0}
+    logging.info(f"Found {len(writer.variables)} unique variables and {writer.rows} time points")
+    write_levels(output_file, writer.codec, writer.block_rows)
+    names = {v["name"]: v["id"] for v in all_variables}
+    for f in filters:
+        # materialized filters, as serialized by the filters endpoint
+        write_filter(output_file, f["id"], f["expression"], names, writer.codec, writer.block_rows)
+    with RunDataPoints(run_id, output_file, cached=False) as data:
+        variables = data.variable_stats()
 
     backup_output_file(run_id)
     start = datetime.datetime.fromtimestamp(writer.start / 1000, tz=timezone)
     end = datetime.datetime.fromtimestamp(writer.end / 1000, tz=timezone)
 
     logging.info(f"Imported {end-start} of data")
-    return {'status': 10, 'progress': 1, 'start': str(start), 'end': str(end)}
+    return {'status': 10, 'progress': 1, 'start': str(start), 'end': str(end), 'variables': variables}
 
 
-## below is my modified version of CANParser to fix timezone issue and also be braver than thomas
-# TODO move this back to WURacing/canparser
-
-@dataclass
-class Packet:
-    timestamp: int
-    epoch: bool
-    extended: bool
-    msg_id: int
-    data: bytes
+class DataWriter:
+    """
+    Writes decoded messages into a run file in a single pass.
 
-@dataclass
-class Signal:
-    timestamp: int
-    epoch: bool
-    sender: str
-    msg_name: str
-    sig_name: str
-    sig_val: float
-    units: str
+    Rows (unique timestamps) are appended to resizable datasets as messages arrive, and columns are added the first
+    time a variable is seen. Only the most recent ``block_rows`` rows are held in memory, so memory use doesn't depend
+    on the length of the log. Logs are expected to be in time order; if they aren't, the file is sorted once at the end.
 
-@dataclass
-class Message:
-    timestamp: int
-    epoch: bool
-    msg_id: int
-    msg_name: str
-    sender: str
-    signals: List[Signal]
-
-
-class CANParser:
-    def __init__(self, dbc_file, input_file):
-        self.db = cantools.database.load_file(dbc_file)
-        self.input_file = input_file
-
-    def packets(self):
-        with open(self.input_file, 'r', newline='', errors='ignore') as f:
-            reader = csv.DictReader(f)
-            if "year" not in reader.fieldnames:
-                raise ValueError("Invalid CSV file format")
-            for row in reader:
-                try:
-                    date = datetime.datetime(int(row["year"]), int(row["month"]), int(row["day"]), int(row["hour"]),
-                                             int(row["min"]), int(row["sec"]), int(row["ms"]) * 1000, tzinfo=timezone)
-                    timestamp = int(date.timestamp() * 1000)
-                    msg_id = int(row["id"], 16) & EXTENDED_MASK
-                    data = bytes.fromhex(row["data"])
-
-                    if len(data) < 8:
-                        break
-                except:
-                    break
-
-                # Epoch and extended are assumed for now
-                yield Packet(timestamp, False, True, msg_id, data)
+    Two layouts are supported. "dense" stores one R x C ``data`` block sharing a single ``timestamps`` column, with NaN
+    wherever a variable wasn't sent. "sparse" stores each variable as its own ``series/<variable id>/timestamps`` and
+    ``series/<variable id>/values`` pair, holding only the times that variable was actually sent. Variables that are
+    always sent together (signals of the same message) share one ``timebases/<n>`` dataset, hard linked as each of
+    their ``timestamps``.
 
+    Datasets are chunked ``block_rows`` rows at a time, and dense blocks ``block_columns`` variables wide, so a narrow
+    chunk lets one variable be read without decompressing the others. The cache holds exactly one chunk of rows, so
+    each flush writes whole chunks.
     """
-    We could memoize- but these lists don't typically get 
-    longer than ~8; doesn't seem worth it
-    """
-
-    def __get_units_from_signals(self, signals, sig_name):
-        for signal in signals:
-            if signal.name == sig_name:
-                return signal.unit
-
-    def messages(self):
-        for packet in self.packets():
-            msg = Message(packet.timestamp, packet.epoch, packet.msg_id, "", "", [])
-            try:
-                msg_inf = self.db.get_message_by_frame_id(msg.msg_id)
-            except KeyError:
-                print(f"Missing {msg.msg_id} in DBC")
-                continue
-            msg.msg_name = msg_inf.name
-            """
-            I am choosing to assume that all messages will have only one sender
-            I do not see this changing on our bus any time soon, but make note
-            of this line if it does
-            """
-            msg.sender = msg_inf.senders[0]
-            signals = self.db.decode_message(msg_inf.frame_id, packet.data)
-            for sig_name, sig_val in signals.items():
-                signal = Signal(msg.timestamp, msg.epoch, msg.sender, msg_inf.name, sig_name, sig_val,
-                                self.__get_units_from_signals(
-                              msg_inf.signals,
-                              sig_name
-                          ))
-                msg.signals.append(signal)
-            yield msg
 
-class DataWriter:
-    def __init__(self, out_file, variables, times):
+    def __init__(self, out_file, variables, block_rows=1000, codec: Codec = None, layout="dense", block_columns=16):
+        if layout not in RUN_LAYOUTS:
+            raise ValueError(f"Unknown run file layout {layout}")
         self.out_file = out_file
-        self.variables = variables
-        self.times = times
+        self.codec = codec or Codec()
+        self.layout = layout
+        self.block_columns = block_columns
+        # variables that may be stored, by name
+        self.known_variables = {v["name"]: v for v in variables}
+        # variables actually present in the log, in column order
+        self.variables = []
+        self.unknown_variables = set()
+        self.block_rows = block_rows
 
         self.start = self.end = None
-
-        self.cache = None
-        self.cache_start = 0
+        self.rows = 0
 
     def __enter__(self):
         self.db = h5py.File(self.out_file, "w")
-
-        # create block
-        R = len(self.times)
-        C = len(self.variables)
-        self.block = self.db.create_dataset("data", (R, C), dtype=np.float64, compression="gzip", fillvalue=np.nan)
-        # look up rows by timestamp, cols by variable. build hash tables
-        self.ts_to_row = {ts: row for row, ts in enumerate(self.times)}
-        self.var_to_col = {var["name"]: col for col, var in enumerate(self.variables)}
-
-        self.cache = np.full((min(1000, R), C), np.nan)
+        self.db.attrs["layout"] = self.layout
+
+        if self.layout == "dense":
+            self.block = self.db.create_dataset("data", (0, 0), maxshape=(None, None), dtype=np.float64,
+                                                chunks=(self.block_rows, self.block_columns), fillvalue=np.nan,
+                                                **self.codec.options())
+            self.timestamps = self.db.create_dataset("timestamps", (0,), maxshape=(None,), dtype=np.int64,
+                                                     chunks=(self.block_rows,), **self.codec.options(shuffle=True))
+        else:
+            # per column values datasets, and the timebase each column's timestamps are linked to
+            self.series = []
+            self.col_timebase = []
+            self.timebases = []
+        # look up cols by variable, and rows by timestamp for rows still in the cache
+        self.var_to_col = {}
+        self.ts_to_row = {}
+        self.last_ts = None
+        self.in_order = True
+
+        self.cache = np.full((self.block_rows, 0), np.nan)
+        self.cache_times = np.zeros((self.block_rows,), dtype=np.int64)
+        self.cache_len = 0
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        R = len(self.times)
-        C = len(self.variables)
+        if exc_type is not None:
+            self.db.close()
+            return
 
-        self.block[self.cache_start:, :] = self.cache
+        self.flush()
+        if not self.in_order:
+            logger.warning(f"Messages in {self.out_file} are out of order, sorting")
+            self.sort()
 
-        maxlen = max([len(s["name"]) for s in self.variables])
+        C = len(self.variables)
+        maxlen = max([len(s["name"]) for s in self.variables], default=1)
         vnames = self.db.create_dataset("variables/names", (C,), dtype=f"S{maxlen}")
         vnames[:] = np.string_([s["name"] for s in self.variables])
         vids = self.db.create_dataset("variables/ids", (C,), dtype=np.int32)
         vids[:] = [s["id"] for s in self.variables]
-        timestamps = self.db.create_dataset("timestamps", (R,), dtype=np.int64, compression="gzip")
-        timestamps[:] = self.times
-        self.db.attrs["start"] = self.start
-        self.db.attrs["end"] = self.end
+        if self.layout == "dense" and self.rows > 0:
+            self.start = int(self.timestamps[0])
+            self.end = int(self.timestamps[self.rows - 1])
+        elif self.layout == "sparse":
+            bounds = [(int(ts[0]), int(ts[-1])) for ts in self.timebases if ts.shape[0] > 0]
+            if len(bounds) > 0:
+                self.start = min(b[0] for b in bounds)
+                self.end = max(b[1] for b in bounds)
+        if self.start is not None:
+            self.db.attrs["start"] = self.start
+            self.db.attrs["end"] = self.end
 
         self.db.close()
 
     def write_message(self, msg: Message):
-        row = self.ts_to_row[msg.timestamp]
-
-        cacheend = self.cache_start + self.cache.shape[0]
-        if row >= cacheend:
-            R = len(self.times)
-            C = len(self.variables)
-            self.block[self.cache_start:cacheend, :] = self.cache
-            self.cache_start += 1000
-            self.cache = np.full((min(1000, R - self.cache_start), C), np.nan)
+        row = self.ts_to_row.get(msg.timestamp)
+        if row is None:
+            row = self.append_row(msg.timestamp)
 
         for sig in msg.signals:
-            col = self.var_to_col[sig.sig_name]
-            self.cache[row - self.cache_start, col] = sig.sig_val
-
-        if self.start is None:
-            self.start = msg.timestamp
-        self.end = msg.timestamp
-
+            col = self.var_to_col.get(sig.sig_name)
+            if col is None:
+                col = self.add_column(sig.sig_name)
+                if col is None:
+                    continue
+            self.cache[row, col] = sig.sig_val
+
+    def write_block(self, block: DecodedBlock):
+        columns = []
+        for name, values in block.columns.items():
+            col = self.var_to_col.get(name)
+            if col is None:
+                col = self.add_column(name)
+            if col is not None:
+                columns.append((col, values))
+
+        # times we may have seen before are merged one at a time, the rest are copied over in bulk
+        n = len(block)
+        pos = 0 if self.last_ts is None else int(np.searchsorted(block.timestamps, self.last_ts, side="right"))
+        for i in range(pos):
+            ts = int(block.timestamps[i])
+            row = self.ts_to_row.get(ts)
+            if row is None:
+                row = self.append_row(ts)
+            for col, values in columns:
+                if not np.isnan(values[i]):
+                    self.cache[row, col] = values[i]
+
+        while pos < n:
+            if self.cache_len == self.cache.shape[0]:
+                self.flush()
+            count = min(self.cache.shape[0] - self.cache_len, n - pos)
+            rows = slice(self.cache_len, self.cache_len + count)
+            times = block.timestamps[pos:pos + count]
+            self.cache_times[rows] = times
+            for col, values in columns:
+                self.cache[rows, col] = values[pos:pos + count]
+            self.ts_to_row.update(zip(times.tolist(), range(rows.start, rows.stop)))
+            self.cache_len += count
+            self.last_ts = int(times[-1])
+            pos += count
+
+    def append_row(self, timestamp: int) -> int:
+        if self.cache_len == self.cache.shape[0]:
+            self.flush()
+        if self.last_ts is not None and timestamp <= self.last_ts:
+            # an earlier time that has already left the cache
+            self.in_order = False
+        else:
+            self.last_ts = timestamp
+        row = self.cache_len
+        self.cache_times[row] = timestamp
+        self.ts_to_row[timestamp] = row
+        self.cache_len += 1
+        return row
+
+    def add_column(self, name: str):
+        if name not in self.known_variables:
+            if name not in self.unknown_variables:
+                logger.info(f"Skipping unknown variable {name}")
+                self.unknown_variables.add(name)
+            return None
+        col = len(self.variables)
+        variable = self.known_variables[name]
+        self.variables.append(variable)
+        self.var_to_col[name] = col
+        self.cache = np.hstack((self.cache, np.full((self.cache.shape[0], 1), np.nan)))
+        if self.layout == "sparse":
+            group = self.db.create_group(f"series/{variable['id']}")
+            self.series.append(group.create_dataset("values", (0,), maxshape=(None,), dtype=np.float64,
+                                                    chunks=(self.block_rows,), **self.codec.options()))
+            # timestamps are linked once the column is first flushed
+            self.col_timebase.append(None)
+        return col
+
+    def add_timebase(self, copy_from=None) -> int:
+        """
+        Create a new shared timestamps dataset
+
+        :param copy_from: index of a timebase whose timestamps the new one starts with
+        :return: index of the new timebase
+        """
+        index = len(self.timebases)
+        length = 0 if copy_from is None else self.timebases[copy_from].shape[0]
+        timebase = self.db.create_dataset(f"timebases/{index}", (length,), maxshape=(None,), dtype=np.int64,
+                                          chunks=(self.block_rows,), **self.codec.options(shuffle=True))
+        for start in range(0, length, PARTIAL_BLOCK_ROWS):
+            stop = min(start + PARTIAL_BLOCK_ROWS, length)
+            timebase[start:stop] = self.timebases[copy_from][start:stop]
+        self.timebases.append(timebase)
+        return index
+
+    def link_timebase(self, col: int, index: int):
+        group = self.db[f"series/{self.variables[col]['id']}"]
+        if "timestamps" in group:
+            del group["timestamps"]
+        group["timestamps"] = self.timebases[index]
+        self.col_timebase[col] = index
+
+    def flush_series(self, n: int):
+        times = self.cache_times[:n]
+        sent = ~np.isnan(self.cache[:n, :])
+
+        # columns keep sharing a timebase as long as they're sent at the same times
+        groups = {}
+        for col in range(len(self.variables)):
+            groups.setdefault((self.col_timebase[col], sent[:, col].tobytes()), []).append(col)
+
+        # split off columns that stopped matching the rest of their timebase before anything is appended
+        assigned = []
+        used = set()
+        for (index, _), cols in groups.items():
+            if index is None or index in used:
+                index = self.add_timebase(copy_from=index)
+                for col in cols:
+                    self.link_timebase(col, index)
+            used.add(index)
+            assigned.append((index, cols))
+
+        for index, cols in assigned:
+            mask = sent[:, cols[0]]
+            count = int(mask.sum())
+            if count == 0:
+                continue
+            timebase = self.timebases[index]
+            length = timebase.shape[0]
+            timebase.resize((length + count,))
+            timebase[length:] = times[mask]
+            for col in cols:
+                values = self.series[col]
+                values.resize((length + count,))
+                values[length:] = self.cache[:n, col][mask]
+
+    def flush(self):
+        """
+        Move the cached rows to the end of the file
+        """
+        n = self.cache_len
+        if n == 0:
+            return
+        C = len(self.variables)
+        if self.layout == "dense":
+            self.block.resize((self.rows + n, C))
+            if C > 0:
+                self.block[self.rows:, :] = self.cache[:n, :]
+            self.timestamps.resize((self.rows + n,))
+            self.timestamps[self.rows:] = self.cache_times[:n]
+        else:
+            self.flush_series(n)
+        self.rows += n
+
+        self.cache[:, :] = np.nan
+        self.cache_len = 0
+        self.ts_to_row.clear()
+
+    def sort(self):
+        """
+        Put rows in time order, merging rows that share a timestamp (later values win)
+        """
+        if self.layout == "sparse":
+            for index, timebase in enumerate(self.timebases):
+                cols = [col for col, tb in enumerate(self.col_timebase) if tb == index]
+                merged = pd.DataFrame({col: self.series[col][:] for col in cols}).groupby(timebase[:], sort=True).last()
+                timebase.resize((merged.shape[0],))
+                timebase[:] = merged.index.to_numpy(dtype=np.int64)
+                for col in cols:
+                    self.series[col].resize((merged.shape[0],))
+                    self.series[col][:] = merged[col].to_numpy(dtype=np.float64)
+            return
+        times = self.timestamps[:]
+        merged = pd.DataFrame(self.block[:, :]).groupby(times, sort=True).last()
+        self.rows = merged.shape[0]
+        self.block.resize((self.rows, len(self.variables)))
+        self.block[:, :] = merged.to_numpy(dtype=np.float64, na_value=np.nan)
+        self.timestamps.resize((self.rows,))
+        self.timestamps[:] = merged.index.to_numpy(dtype=np.int64)
 
 
 def create_variables(dbc_file: str):
@@ -1,9 +1,8 @@
 import datetime
-from typing import Set
-
-from sympy import sympify
+from typing import List, Set
 
 from . import db
+from .expressions import expression_variables
 
 
 class Filter(db.Model):
@@ -13,6 +12,10 @@ class Filter(db.Model):
     expression = db.Column(db.String(512), default="0", nullable=False)
     description = db.Column(db.String(100))
     units = db.Column(db.String(20))
+    # store the filter's values in run files rather than computing them on every view
+    materialize = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    # loaded along with the filters, so listing them takes a single extra query
+    variables = db.relationship('FilterVariable', cascade="all, delete-orphan", lazy="selectin")
 
     def __repr__(self):
         return f"Filter(name={self.name}, expression={self.expression})"
@@ -23,21 +26,22 @@ class Filter(db.Model):
             "name": self.name,
             "expression": self.expression,
             "description": self.description,
-            "units": self.units
+            "units": self.units,
+            "materialize": self.materialize
         }
         if incl_required:
-            d["required"] = []
-            for v in Variable.query.filter(Variable.name.in_(self.required_variables())).all():
-                d["required"].append(v.id)
+            d["required"] = [fv.variable_id for fv in self.variables]
         return d
 
     def required_variables(self) -> Set[str]:
-        expr = sympify(self.expression)
-        required = set()
-        for free in expr.expr_free_symbols:
-            if free.is_Symbol:
-                required.add(free.name)
-        return required
+        return set(expression_variables(self.expression))
+
+    def set_expression(self, expression: str, variables: List["Variable"]):
+        """
+        Change the expression along with the variables it requires, as found by validate_filter_expression
+        """
+        self.expression = expression
+        self.variables = [FilterVariable(variable_id=v.id) for v in variables]
 
 
 
@@ -69,6 +73,9 @@ class Run(db.Model):
     runofday = db.Column(db.Integer)
     start = db.Column(db.DateTime())
     end = db.Column(db.DateTime())
+    # whether variables lists everything in the run's data file, which may be nothing
+    catalogued = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    variables = db.relationship('RunVariable', cascade="all, delete-orphan")
 
     def __repr__(self):
         return f"Run(id={self.id}, location={self.location}, runofday={self.runofday}, start={self.start})"
@@ -90,6 +97,34 @@ class Run(db.Model):
         return self.start < start < self.end or self.start < end < self.end
 
 
+class FilterVariable(db.Model):
+    """
+    A variable required by a filter, stored when the filter is written so finding the filters that apply to a set of
+    variables is a single query
+    """
+    __tablename__ = "datafiltervariables"
+    filter_id = db.Column(db.Integer, db.ForeignKey('datafilters.id'), primary_key=True)
+    variable_id = db.Column(db.Integer, db.ForeignKey('datavariables.id'), primary_key=True, index=True)
+
+    def __repr__(self):
+        return f"FilterVariable(filter_id={self.filter_id}, variable_id={self.variable_id})"
+
+
+class RunVariable(db.Model):
+    """
+    A variable recorded in a run, so run details don't need the run's data file
+    """
+    __tablename__ = "datarunvariables"
+    run_id = db.Column(db.Integer, db.ForeignKey('datarunmeta.id'), primary_key=True)
+    variable_id = db.Column(db.Integer, db.ForeignKey('datavariables.id'), primary_key=True, index=True)
+    samples = db.Column(db.Integer, nullable=False, default=0)
+    start = db.Column(db.DateTime())
+    end = db.Column(db.DateTime())
+
+    def __repr__(self):
+        return f"RunVariable(run_id={self.run_id}, variable_id={self.variable_id}, samples={self.samples})"
+
+
 class TestingDay(db.Model):
     __tablename__ = "testingdays"
     date = db.Column(db.Date, primary_key=True)
@@ -0,0 +1,110 @@
+"""
+Shared cache of encoded responses in the Redis instance used by Celery, for queries whose results can't change any more.
+
+Bodies are stored gzip compressed, under keys built from the day and a hash of everything the response depends on.
+Each testing day also has a generation number that is part of its keys, so bumping it drops every cached response of
+the day at once. Old entries are left to expire.
+"""
+import hashlib
+import logging
+import zlib
+from typing import Iterable, Iterator, Optional, Union
+
+import redis
+from flask import request
+
+from dataviewerapi import app
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "dataviewer:responses"
+
+_client = None
+
+
+def redis_client() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(app.config["REDIS_URL"])
+    return _client
+
+
+def enabled() -> bool:
+    return app.config["RESPONSE_CACHE_TTL"] > 0
+
+
+def day_key(day: str, *parts) -> Optional[str]:
+    """
+    Key of a response of a testing day, or None if the cache can't be used
+    :param parts: everything the response depends on
+    """
+    try:
+        generation = int(redis_client().get(f"{PREFIX}:{day}:generation") or 0)
+    except redis.RedisError as e:
+        logger.warning(f"Response cache unavailable: {e}")
+        return None
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()
+    return f"{PREFIX}:{day}:{generation}:{digest}"
+
+
+def invalidate_day(day: str):
+    """
+    Drop every cached response of a testing day
+    """
+    if not enabled():
+        return
+    try:
+        redis_client().incr(f"{PREFIX}:{day}:generation")
+    except redis.RedisError as e:
+        logger.warning(f"Couldn't invalidate cached responses of {day}: {e}")
+
+
+def get(key: str) -> Optional[bytes]:
+    """
+    :return: the gzip compressed body stored under key, if any
+    """
+    try:
+        return redis_client().get(key)
+    except redis.RedisError as e:
+        logger.warning(f"Response cache unavailable: {e}")
+        return None
+
+
+def storing(key: str, body: Iterable[Union[str, bytes]]) -> Iterator[bytes]:
+    """
+    Stream a body while compressing a copy of it, which is stored under key once the body is complete, unless it grows
+    beyond RESPONSE_CACHE_MAX_BYTES compressed
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    parts, size = [], 0
+    for chunk in body:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if parts is not None:
+            part = compressor.compress(chunk)
+            size += len(part)
+            if size > app.config["RESPONSE_CACHE_MAX_BYTES"]:
+                parts = None
+            else:
+                parts.append(part)
+        yield chunk
+    if parts is None:
+        return
+    parts.append(compressor.flush())
+    if size + len(parts[-1]) > app.config["RESPONSE_CACHE_MAX_BYTES"]:
+        return
+    try:
+        redis_client().set(key, b"".join(parts), ex=app.config["RESPONSE_CACHE_TTL"])
+    except redis.RedisError as e:
+        logger.warning(f"Couldn't cache response: {e}")
+
+
+def accepts_gzip() -> bool:
+    return "gzip" in request.headers.get("Accept-Encoding", default="").lower()
+
+
+def decompressed(data: bytes, chunk_size=1024 * 1024) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj(31)
+    for start in range(0, len(data), chunk_size):
+        yield decompressor.decompress(data[start:start + chunk_size])
+    yield decompressor.flush()
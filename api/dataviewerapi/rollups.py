@@ -0,0 +1,150 @@
+"""
+Pre-aggregated copies of testing day tables, so coarse reads don't scan every raw millisecond row.
+
+A rollup of a day table ``YYYYMMDD`` at a bucket width is the table ``YYYYMMDD_<width>`` (``_100ms``, ``_1s``, ``_10s``,
+``_1m``) holding one row per bucket with data: ``index``, the first raw index in the bucket, and for every variable
+``<variable>__min``, ``__max``, ``__avg``, ``__std``, ``__n`` (the number of non-NULL values), ``__first`` and
+``__last``. Each rollup is built from the next finer one, and coarser queries combine rollup rows the same way.
+"""
+import logging
+from typing import Dict, List, Optional
+
+from sqlalchemy import inspect, text
+
+from dataviewerapi import db
+
+logger = logging.getLogger(__name__)
+
+# bucket width (ms) of each rollup, finest first, with its table name suffix
+ROLLUPS = {100: "100ms", 1000: "1s", 10000: "10s", 60000: "1m"}
+# columns stored per variable
+STATS = ("min", "max", "avg", "std", "n", "first", "last")
+
+
+def rollup_table(table: str, width: int) -> str:
+    return f"{table}_{ROLLUPS[width]}"
+
+
+def first_value(table: str, column: str, order="ASC") -> str:
+    """
+    First non-NULL value of a column in a group, by index (the last one with order DESC). GROUP_CONCAT skips NULLs and
+    keeps the start of its result if it's cut at group_concat_max_len, so only the first item is used. The index is
+    qualified, as queries select MIN(`index`) AS `index`
+    """
+    return f"SUBSTRING_INDEX(GROUP_CONCAT(`{column}` ORDER BY `{table}`.`index` {order}), ',', 1) + 0"
+
+
+def raw_stats(table: str, variable: str) -> Dict[str, str]:
+    """
+    Aggregates of a variable over raw rows of a table, by rollup column
+    """
+    v = f"`{variable}`"
+    return {"min": f"MIN({v})", "max": f"MAX({v})", "avg": f"AVG({v})", "std": f"STD({v})", "n": f"COUNT({v})",
+            "first": first_value(table, variable), "last": first_value(table, variable, "DESC")}
+
+
+def combined_avg(variable: str) -> str:
+    return f"SUM(`{variable}__avg` * `{variable}__n`) / SUM(`{variable}__n`)"
+
+
+def combined_std(variable: str) -> str:
+    # population variance of the union of buckets: mean of (variance + mean^2), less the overall mean^2
+    v = variable
+    return f"SQRT(GREATEST(SUM(`{v}__n` * (POW(`{v}__std`, 2) + POW(`{v}__avg`, 2))) / SUM(`{v}__n`) - " \
+           f"POW({combined_avg(v)}, 2), 0))"
+
+
+def combined_stats(table: str, variable: str) -> Dict[str, str]:
+    """
+    Aggregates of a variable over rows of a rollup table, by rollup column
+    """
+    return {"min": f"MIN(`{variable}__min`)", "max": f"MAX(`{variable}__max`)", "avg": combined_avg(variable),
+            "std": combined_std(variable), "n": f"SUM(`{variable}__n`)",
+            "first": first_value(table, f"{variable}__first"), "last": first_value(table, f"{variable}__last", "DESC")}
+
+
+def table_times(table: str) -> Optional[Dict[str, object]]:
+    """
+    Creation times of a day table and its rollups, by name. A table's creation time also changes when it's altered.
+    None if the database doesn't give creation times
+    """
+    if db.engine.dialect.name != "mysql":
+        return None
+    rows = db.engine.execute(text("SELECT TABLE_NAME, CREATE_TIME FROM information_schema.TABLES "
+                                  "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME LIKE :prefix"),
+                             prefix=f"{table}%").fetchall()
+    return {name: created for name, created in rows if name == table or name.startswith(f"{table}_")}
+
+
+def available_rollups(table: str, times: Optional[Dict[str, object]]) -> List[int]:
+    """
+    Widths of the rollups of a day table that exist, have every column of STATS and were built after the table was
+    last (re)created
+    """
+    inspector = inspect(db.engine)
+    if times is None:
+        names = set(inspector.get_table_names())
+        widths = [width for width in ROLLUPS if rollup_table(table, width) in names]
+    else:
+        created = times.get(table)
+        widths = [width for width in ROLLUPS if rollup_table(table, width) in times and
+                  (created is None or times[rollup_table(table, width)] >= created)]
+    # rollups built before first and last were stored need rebuilding
+    return [width for width in widths if
+            any(c["name"].endswith("__last") for c in inspector.get_columns(rollup_table(table, width)))]
+
+
+def choose_rollup(available: List[int], width: Optional[int], start: int, end: int) -> Optional[int]:
+    """
+    The coarsest available rollup whose buckets fit evenly into buckets of the given width (any, if width is None),
+    with at least one bucket entirely inside [start, end], or None to read raw rows
+    """
+    fits = [r for r in available if (width is None or width % r == 0) and -(-start // r) * r + r - 1 <= end]
+    return max(fits) if len(fits) > 0 else None
+
+
+# name of the derived table given by rollup_source
+ROLLUP_ALIAS = "buckets"
+
+
+def rollup_source(table: str, width: int, start: int, end: int, variables: List[str]) -> str:
+    """
+    Rollup rows at a width covering exactly [start, end] of a day table, as a derived table named ROLLUP_ALIAS: the
+    stored rows of buckets entirely inside, and the buckets cut by start or end rolled up from raw rows on the fly,
+    so no data outside the interval is included
+    """
+    first = -(-start // width) * width
+    stop = (end + 1) // width * width
+    parts = ["SELECT `index`, " + ", ".join(f"`{v}__{stat}`" for v in variables for stat in STATS) +
+             f" FROM `{rollup_table(table, width)}` WHERE `index` BETWEEN {first} AND {stop - 1}"]
+    for edge_start, edge_end in ((start, first - 1), (stop, end)):
+        if edge_start <= edge_end:
+            parts.append("SELECT MIN(`index`) AS `index`, " + ", ".join(
+                f"{expr} AS `{v}__{stat}`" for v in variables for stat, expr in raw_stats(table, v).items()) +
+                f" FROM `{table}` WHERE `index` BETWEEN {edge_start} AND {edge_end} GROUP BY `index` DIV {width}")
+    return "(" + " UNION ALL ".join(parts) + f") AS `{ROLLUP_ALIAS}`"
+
+
+def build_rollups(table: str, variables: List[str]):
+    """
+    (Re)build all rollups of a day table. Each is written under a temporary name and swapped in, so readers always
+    see a complete table
+    """
+    names = set(inspect(db.engine).get_table_names())
+    source, stats = table, raw_stats
+    for width in ROLLUPS:
+        target = rollup_table(table, width)
+        selection = ", ".join(["MIN(`index`) AS `index`"] + [
+            f"{expr} AS `{v}__{stat}`" for v in variables for stat, expr in stats(source, v).items()])
+        with db.engine.begin() as conn:
+            conn.execute(f"DROP TABLE IF EXISTS `{target}_new`")
+            conn.execute(f"CREATE TABLE `{target}_new` AS SELECT {selection} FROM `{source}` "
+                         f"GROUP BY `index` DIV {width}")
+            conn.execute(f"ALTER TABLE `{target}_new` ADD PRIMARY KEY (`index`)")
+            if target in names:
+                conn.execute(f"RENAME TABLE `{target}` TO `{target}_old`, `{target}_new` TO `{target}`")
+                conn.execute(f"DROP TABLE `{target}_old`")
+            else:
+                conn.execute(f"RENAME TABLE `{target}_new` TO `{target}`")
+        logger.info(f"Built rollup {target}")
+        source, stats = target, combined_stats
@@ -1 +1 @@
-from . import runs, filters, variables, testingday, interval
\ No newline at end of file
+from . import runs, filters, variables, testingday, interval, export
\ No newline at end of file
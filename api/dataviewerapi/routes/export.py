@@ -0,0 +1,77 @@
+import datetime
+import uuid
+
+from flask import request, jsonify, abort, send_file
+
+from dataviewerapi import app, models
+from dataviewerapi.jobs.export import EXPORT_FORMATS, export_interval_data, remove_expired_exports, \
+    resolve_export_file
+from dataviewerapi.routes.testingday import build_interval_query
+
+
+@app.route("/api/v2/testing/<day:date>/<time:start>/<time:end>/export", methods=["POST"])
+def export_time_interval_data(date, start, end):
+    """
+    Queue an export of the same data as the data endpoint, taking the same arguments plus format (csv or bin), to be
+    downloaded once it's done
+    """
+    t = models.TestingDay.query.get_or_404(date, description='Date not found')
+    fmt = request.args.get('format', default='csv')
+    if fmt not in EXPORT_FORMATS:
+        abort(400, 'Unsupported format')
+    query, columns, bounds = build_interval_query(t, date, start, end)
+    daystart = datetime.datetime.combine(date, t.start)
+    export_id = str(uuid.uuid4())
+    # exports go to their own queue, so they can be given workers apart from imports
+    export_interval_data.apply_async((query, columns, daystart.isoformat(), fmt, bounds), task_id=export_id,
+                                     queue=app.config["EXPORT_QUEUE"])
+    return jsonify({"id": export_id}), 202
+
+
+@app.route("/api/v2/testing/exports/<uuid:export_id>", methods=["GET"])
+def read_export_status(export_id):
+    task = export_interval_data.AsyncResult(str(export_id))
+    if task.state == 'PENDING':
+        # job did not start yet
+        response = {
+            "id": str(export_id),
+            "status": 0,
+            "progress": 0
+        }
+    elif task.state != 'FAILURE':
+        response = {
+            "id": str(export_id),
+            "status": task.info.get('status', 0),
+            "progress": task.info.get('progress', 0)
+        }
+        if 'file' in task.info:
+            response["size"] = task.info["size"]
+    else:
+        # something went wrong in the background job
+        response = {
+            'id': str(export_id),
+            'status': 9,
+            'progress': 1,
+            'error': str(task.info),  # this is the exception raised
+        }
+    return jsonify(response)
+
+
+@app.route("/api/v2/testing/exports/<uuid:export_id>/file", methods=["GET"])
+def read_export_file(export_id):
+    """
+    Download a finished export, with support for Range requests to resume
+    """
+    task = export_interval_data.AsyncResult(str(export_id))
+    # unknown ids are PENDING, so only exports the result backend knows as finished are looked for
+    if task.state != 'SUCCESS':
+        abort(404, 'Export not found')
+    remove_expired_exports()
+    name = task.info["file"]
+    try:
+        path = resolve_export_file(name)
+    except FileNotFoundError:
+        abort(404, 'Export not found')
+    response = send_file(path, mimetype='application/gzip', conditional=True)
+    response.headers["Content-Disposition"] = f'attachment; filename="{name}"'
+    return response
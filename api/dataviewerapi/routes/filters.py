@@ -1,16 +1,31 @@
 from typing import Iterable
 
-from flask_restful import Resource, reqparse, abort
+import logging
+
+from flask_restful import Resource, inputs, reqparse, abort
 
 from dataviewerapi import db, api, models
+from dataviewerapi.jobs.filters import materialize_filter
 from dataviewerapi.util import validate_filter_name, validate_filter_expression, validate_filter_description, \
-    validate_filter_units
+    validate_filter_units, get_runs_with_variables
 
 parser = reqparse.RequestParser()
 parser.add_argument("name")
 parser.add_argument("expression")
 parser.add_argument("description")
 parser.add_argument("units")
+parser.add_argument("materialize", type=inputs.boolean)
+
+logger = logging.getLogger(__name__)
+
+
+def queue_materialize(f: models.Filter):
+    """
+    Queue storing a materialized filter's values in every run that has its variables
+    """
+    run_ids = get_runs_with_variables([fv.variable_id for fv in f.variables])
+    materialize_filter.apply_async((f.serialize(), [v.serialize() for v in models.Variable.query.all()], run_ids))
+    logger.info(f"Queued materializing filter {f.name} in {len(run_ids)} runs")
 
 
 class Filters(Resource):
@@ -23,14 +38,17 @@ class Filters(Resource):
         validate_filter_name(args)
         if models.Filter.query.filter(models.Filter.name == args["name"]).count() > 0:
             abort(400, error="Filter with this name already exists")
-        validate_filter_expression(args)
-        validate_filter_expression(args)
+        variables = validate_filter_expression(args)
+        validate_filter_description(args)
         validate_filter_units(args)
         # create new
-        f = models.Filter(name=args["name"], expression=args["expression"], description=args["description"],
-                          units=args["units"])
+        f = models.Filter(name=args["name"], description=args["description"], units=args["units"],
+                          materialize=bool(args["materialize"]))
+        f.set_expression(args["expression"], variables)
         db.session.add(f)
         db.session.commit()
+        if f.materialize:
+            queue_materialize(f)
         return {"name": f.name}, 201
 
 
@@ -38,19 +56,27 @@ class FilterDetails(Resource):
     def patch(self, name):
         f: models.Filter = models.Filter.query.filter(models.Filter.name == name).first_or_404()
         args = parser.parse_args()
+        stale = False
         # update if changed
         if args["name"] is not None:
             validate_filter_name(args)
             f.name = args["name"]
         if args["expression"] is not None:
-            validate_filter_expression(args)
-            f.expression = args["expression"]
+            variables = validate_filter_expression(args)
+            stale = args["expression"] != f.expression
+            f.set_expression(args["expression"], variables)
         validate_filter_description(args)
         f.description = args["description"]
         validate_filter_units(args)
         f.units = args["units"]
+        if args["materialize"] is not None:
+            stale |= args["materialize"] and not f.materialize
+            f.materialize = args["materialize"]
         db.session.add(f)
         db.session.commit()
+        # values stored for the old expression are ignored from now on, recompute them
+        if f.materialize and stale:
+            queue_materialize(f)
         return {"name": f.name}, 200
 
     def delete(self, name):
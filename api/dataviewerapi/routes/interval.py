@@ -2,7 +2,7 @@ import datetime
 
 from flask import request, jsonify, abort
 
-from dataviewerapi import db, app, models
+from dataviewerapi import db, app, models, responses
 
 eod = datetime.time(23, 59, 59, 999000)
 
@@ -46,6 +46,7 @@ def create_interval(date):
 
     db.session.add(interval)
     db.session.commit()
+    responses.invalidate_day(date.strftime('%Y%m%d'))
     return jsonify({"id": interval.id}), 201
 
 
@@ -84,6 +85,7 @@ def update_interval(date, interval_id):
 
     db.session.add(interval)
     db.session.commit()
+    responses.invalidate_day(date.strftime('%Y%m%d'))
     return jsonify({"id": interval_id}), 200
 
 
@@ -94,5 +96,6 @@ def delete_interval(date, interval_id):
 
     db.session.delete(interval)
     db.session.commit()
+    responses.invalidate_day(date.strftime('%Y%m%d'))
     return jsonify({"id": interval_id}), 200
 
@@ -1,22 +1,24 @@
 import datetime
+import hashlib
 import json
 import os
 from typing import Iterable
 import logging
 
-import boto3
 import dateutil.parser
 import numpy as np
 from botocore.exceptions import ClientError
 from flask import request
-from flask_restful import Resource, reqparse
+from flask_restful import Resource, abort, reqparse
 from werkzeug.wrappers import Response
 
-from dataviewerapi import db, app, api, models, jobs
-from dataviewerapi.data import RunDataPoints
+from dataviewerapi import db, app, api, models
+from dataviewerapi.binary import MEDIA_TYPE, accepts_frames, frames
+from dataviewerapi.data import RunDataPoints, lttb, run_cache, s3_client
+from dataviewerapi.expressions import evaluate, expression_variables
 from dataviewerapi.util import validate_run_location, validate_run_description, validate_run_type, \
-    get_included_variables, get_appropriate_filters
-from dataviewerapi.jobs.run import create_variables, import_run
+    get_included_variables, get_appropriate_filters, record_run_variables, catalog_runs, json_array
+from dataviewerapi.jobs.run import create_variables, downsample, import_run
 
 uploadparser = reqparse.RequestParser()
 uploadparser.add_argument("location")
@@ -51,14 +53,15 @@ class Runs(Resource):
         file.save(infile)
         if app.config["UPLOAD_BUCKET"] is not None:
             try:
-                boto3.client("s3").upload_file(infile, app.config["UPLOAD_BUCKET"], f"{r.id}.csv")
+                s3_client().upload_file(infile, app.config["UPLOAD_BUCKET"], f"{r.id}.csv")
             except ClientError as e:
                 logger.warning(e)
         dbcfile = app.config["DBC"]
         # ensure all signals from this DBC are in the variables table
         create_variables(dbcfile)
         # queue the background job
-        import_run.apply_async((r.id, [v.serialize() for v in models.Variable.query.all()]),
+        import_run.apply_async((r.id, [v.serialize() for v in models.Variable.query.all()],
+                                [f.serialize() for f in models.Filter.query.filter(models.Filter.materialize).all()]),
                                task_id=f"{r.id}")
         return {"id": r.id}, 202
 
@@ -86,6 +89,8 @@ class Processing(Resource):
                 f.end = dateutil.parser.parse(task.info["end"]).astimezone(datetime.timezone.utc)
                 db.session.add(f)
                 db.session.commit()
+                if not f.catalogued and "variables" in task.info:
+                    record_run_variables(f, task.info["variables"])
         else:
             # something went wrong in the background job
             response = {
@@ -138,24 +143,15 @@ class RunDetails2(RunDetails):
 
 class RangeDetails(Resource):
     def get(self, start, end):
-        # find all runs
-        runs: Iterable[models.Run] = models.Run.query.filter(db.or_(
-            db.and_(start <= models.Run.start, models.Run.start <= end),
-            db.and_(start <= models.Run.end, models.Run.end <= end))).all()
+        overlaps = db.and_(models.Run.start <= end, start <= models.Run.end)
+        # runs imported before the catalog existed are catalogued from their files once
+        catalog_runs(models.Run.query.filter(overlaps, ~models.Run.catalogued).all())
         # if len(runs) == 0:
         #     return {"error": "No runs found for this range"}, 404
 
-        variables = []
         filters = []
-        uniq_vars = set()
-        for run in runs:
-            with RunDataPoints(run.id) as data:
-                lclvars = set(data.variables())
-                remvars = lclvars.difference(uniq_vars)
-                uniq_vars = uniq_vars.union(lclvars)
-
-                v = models.Variable.query.filter(models.Variable.id.in_(remvars)).all()
-                variables += [f.serialize() for f in v]
+        v = models.Variable.query.join(models.RunVariable).join(models.Run).filter(overlaps).distinct().all()
+        variables = [f.serialize() for f in v]
 
         meta = {
             "id": -1,
@@ -169,55 +165,219 @@ class RangeDetails(Resource):
         return {"meta": meta, "variables": variables, "filters": filters}
 
 
+pointsparser = reqparse.RequestParser()
+pointsparser.add_argument("downsample", choices=("levels", "lttb"), default="levels", location="args")
+pointsparser.add_argument("format", choices=("rows", "columns", "binary"), location="args")
+# filter IDs, evaluated on the server and returned as extra columns named after the filters
+pointsparser.add_argument("filters", type=lambda value: [int(v) for v in value.split(",")], default=[],
+                          location="args")
+
+
+def row_entries(blocks, vnames):
+    """
+    One JSON object per time point (or bucket) holding the variables with data there
+    """
+    for timestamps, values, mins, maxs in blocks:
+        for i, ts in enumerate(timestamps):
+            entry = {"time": datetime.datetime.fromtimestamp(ts / 1000, datetime.timezone.utc).isoformat()}
+            if mins is None:
+                for vn, col in zip(vnames, values[i]):
+                    if not np.isnan(col):  # has data
+                        entry[vn] = col
+                if len(entry.keys()) > 1:
+                    yield json.dumps(entry)
+                continue
+            # downsampled: each entry is a bucket starting at time, with the mean of each variable and its min/max
+            low, high = {}, {}
+            for vn, l, h, m in zip(vnames, mins[i], maxs[i], values[i]):
+                if not np.isnan(m):
+                    entry[vn] = m
+                    low[vn] = l
+                    high[vn] = h
+            if len(low) > 0:
+                entry["min"] = low
+                entry["max"] = high
+                yield json.dumps(entry)
+
+
+def rows_response(blocks, vnames):
+    first = True
+    yield '['
+    for entry in row_entries(blocks, vnames):
+        if first:
+            first = False
+        else:
+            yield ','
+        yield entry
+    yield ']'
+
+
+def trimmed_blocks(blocks):
+    """
+    Drop time points where none of the variables have data, and fill in mins and maxs of full resolution blocks
+    """
+    for timestamps, values, mins, maxs in blocks:
+        keep = ~np.isnan(values).all(axis=1)
+        if mins is None:
+            mins = maxs = values
+        yield timestamps[keep], values[keep], mins[keep], maxs[keep]
+
+
+def columns_response(blocks, vnames, downsampled: bool):
+    """
+    {"time": [ms since the epoch], "variables": {name: [value or null]}}, plus "min" and "max" in the same shape as
+    "variables" when downsampled
+    """
+    parts = list(trimmed_blocks(blocks))
+    timestamps = np.concatenate([np.zeros((0,), dtype=np.int64)] + [p[0] for p in parts])
+    stats = [("variables", 1)] + ([("min", 2), ("max", 3)] if downsampled else [])
+    yield '{"time":'
+    yield from json_array(timestamps)
+    for key, index in stats:
+        data = np.concatenate([np.zeros((0, len(vnames)))] + [p[index] for p in parts])
+        yield f',"{key}":{{'
+        for col, vn in enumerate(vnames):
+            yield ("," if col > 0 else "") + json.dumps(vn) + ":"
+            yield from json_array(data[:, col])
+        yield '}'
+    yield '}'
+
+
+def binary_response(blocks, vnames, downsampled: bool):
+    """
+    Framed binary columns: "time" (int64 ms since the epoch) and a float64 column per variable, plus "<name>.min" and
+    "<name>.max" columns when downsampled. Each run's arrays are sent as they're read
+    """
+    columns = [("time", np.int64)] + [(vn, np.float64) for vn in vnames]
+    if downsampled:
+        columns += [(f"{vn}.{stat}", np.float64) for stat in ("min", "max") for vn in vnames]
+
+    def batches():
+        for timestamps, values, mins, maxs in trimmed_blocks(blocks):
+            stats = (values, mins, maxs) if downsampled else (values,)
+            yield [timestamps] + [data[:, col] for data in stats for col in range(len(vnames))]
+    return frames(columns, batches())
+
+
 class DataPoints(Resource):
     def get(self, start, end, sample_size, variables):
+        args = pointsparser.parse_args()
         vs = models.Variable.query.filter(models.Variable.id.in_(variables)).all()
         vnames = [v.name for v in vs]
-        # find all runs that coincide with this range
-        runs: Iterable[models.Run] = models.Run.query.filter(db.or_(
-            db.and_(start <= models.Run.start, models.Run.start <= end),
-            db.and_(start <= models.Run.end, models.Run.end <= end))).all()
-        entries = []
+        vids = [v.id for v in vs]
+        fs = models.Filter.query.filter(models.Filter.id.in_(args["filters"])).all() if args["filters"] else []
+        try:
+            inputs = {f.id: expression_variables(f.expression) for f in fs}
+        except Exception as e:
+            abort(400, error=f"Invalid filter expression: {e}")
+        input_ids = {v.name: v.id for v in models.Variable.query.filter(
+            models.Variable.name.in_({name for names in inputs.values() for name in names})).all()}
+        columns = vnames + [f.name for f in fs]
+        # find all runs that overlap this range, including runs that contain all of it (zoomed in views)
+        runs: Iterable[models.Run] = models.Run.query.filter(models.Run.start <= end, start <= models.Run.end).all()
         # try to keep this information in the cache
         lm = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+        versions = []
         for run in runs:
             with RunDataPoints(run.id) as data:
                 modified = data.last_modified()
+                versions.append((run.id, modified.timestamp()))
                 if modified > lm:
                     lm = modified
         lm = lm.replace(microsecond=0)
-        if "if-modified-since" in request.headers:
+        # filters have no modification time, so their expressions are part of the entity tag instead
+        etag = hashlib.sha1(repr((sorted(versions), sorted((f.id, f.expression) for f in fs))).encode()).hexdigest()
+        if "if-none-match" in request.headers:
+            if request.if_none_match.contains(etag):
+                return None, 304
+        elif "if-modified-since" in request.headers and len(fs) == 0:
             ims = request.headers["if-modified-since"]
             ims = dateutil.parser.parse(ims)
             if ims == lm:
                 return None, 304
 
-        # load and send data
-        def load_and_send():
-            first = True
-            yield '['
+        # widest buckets that still give sample_size points over the range, 0 asks for full resolution
+        width = (end - start).total_seconds() * 1000 / sample_size if sample_size > 0 else 0
+        use_lttb = args["downsample"] == "lttb" and sample_size > 0
+
+        def filter_series(data: RunDataPoints, f: models.Filter):
+            # full resolution values of a filter over this run's window, None if the run lacks one of its variables
+            stored = data.filter_series(f.id, f.expression)
+            if stored is not None:
+                return stored
+            return evaluate(f.expression, {name: data.series(input_ids[name]) if name in input_ids else None
+                                           for name in inputs[f.id]})
+
+        def filter_summary(data: RunDataPoints, f: models.Filter, level: int):
+            stored = data.filter_summary(f.id, f.expression, level)
+            if stored is not None:
+                return stored
+            # a filter of bucket means isn't the mean of the filter, so bucket its full resolution values instead
+            s = filter_series(data, f)
+            if s is None or s[0].shape[0] == 0:
+                return None
+            return downsample(s[0], s[1], s[1], s[1], np.ones(s[1].shape), level)
+
+        def run_blocks():
+            """
+            (timestamps, values, mins, maxs) of each run with one column per variable then one per filter, mins and
+            maxs being None at full resolution
+            """
             for run in runs:
-                with RunDataPoints(run.id) as data:
-                    # read only columns containing desired variables
-                    d = data.read(variables)
-                    # build entries for each row (unique time point)
-                    for time, row in zip(data.times(), d):
-                        entry = {"time": time.isoformat()}
-                        for vn, col in zip(vnames, row):
-                            if not np.isnan(col):  # has data
-                                entry[vn] = col
-                        if len(entry.keys()) > 1:
-                            if first:
-                                first = False
-                            else:
-                                yield ','
-                            yield json.dumps(entry)
-            yield ']'
-
-        return Response(load_and_send(), 200, {"Last-Modified": lm.strftime("%a, %d %b %Y %H:%M:%S") + " GMT",
-                                               "Cache-Control": "must-revalidate",
-                                               "Content-Type": "application/json",
-                                               })
+                with RunDataPoints(run.id, start=start, end=end) as data:
+                    level = data.level_for(width)
+                    if level is None and len(fs) == 0:
+                        # read only columns containing desired variables
+                        timestamps, d = data.select(vids)
+                        yield timestamps, d, None, None
+                    elif level is None:
+                        timestamps, d = data.merge([data.series(vid) for vid in vids] +
+                                                   [filter_series(data, f) for f in fs])
+                        yield timestamps, d, None, None
+                    else:
+                        timestamps, mins, maxs, means = data.merge_summaries(
+                            [data.summary(vid, level) for vid in vids] + [filter_summary(data, f, level) for f in fs])
+                        yield timestamps, means, mins, maxs
+
+        def lttb_blocks():
+            # sample_size points of each column within the requested window, picked across all runs
+            series = [[] for _ in columns]
+            for run in sorted(runs, key=lambda r: r.start):
+                with RunDataPoints(run.id, start=start, end=end) as data:
+                    found = [data.series(vid) for vid in vids] + [filter_series(data, f) for f in fs]
+                    for parts, s in zip(series, found):
+                        if s is not None:
+                            parts.append(s)
+            picked = []
+            for parts in series:
+                ts = np.concatenate([np.zeros((0,), dtype=np.int64)] + [p[0] for p in parts])
+                values = np.concatenate([np.zeros((0,))] + [p[1] for p in parts])
+                keep = lttb(ts, values, sample_size)
+                picked.append((ts[keep], values[keep]))
+            timestamps = np.unique(np.concatenate([np.zeros((0,), dtype=np.int64)] + [p[0] for p in picked]))
+            yield timestamps, RunDataPoints.align(timestamps, picked), None, None
+
+        blocks = lttb_blocks() if use_lttb else run_blocks()
+        downsampled = sample_size > 0 and not use_lttb
+        output = args["format"] or ("binary" if accepts_frames() else "rows")
+        if output == "binary":
+            body = binary_response(blocks, columns, downsampled)
+        elif output == "columns":
+            body = columns_response(blocks, columns, downsampled)
+        else:
+            body = rows_response(blocks, columns)
+        return Response(body, 200, {"Last-Modified": lm.strftime("%a, %d %b %Y %H:%M:%S") + " GMT",
+                                    "ETag": f'"{etag}"',
+                                    "Cache-Control": "must-revalidate",
+                                    "Content-Type": MEDIA_TYPE if output == "binary" else "application/json",
+                                    "Vary": "Accept",
+                                    })
+
+
+class CacheStats(Resource):
+    def get(self):
+        # counters of this worker process only
+        return run_cache().stats()
 
 
 api.add_resource(Runs, "/api/runs")
@@ -226,3 +386,4 @@ api.add_resource(RunDetails2, "/api/runs/<run_id>/details")
 api.add_resource(RangeDetails, "/api/runs/range/<date:start>/<date:end>/details")
 api.add_resource(DataPoints, "/api/runs/points/<date:start>/<date:end>/<int:sample_size>/<is:variables>")
 api.add_resource(Processing, "/api/runs/processing/<int:run_id>")
+api.add_resource(CacheStats, "/api/cache")
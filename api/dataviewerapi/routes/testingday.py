@@ -1,15 +1,65 @@
 import datetime
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
+from queue import Full, Queue
+from typing import Callable, Collection, Dict, Iterable, Iterator, List, Optional
 
 import dateutil
 import pytz
 
-import pandas as pd
+import numpy as np
 from flask import Response, request, jsonify, abort
-from sqlalchemy import text
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import joinedload
 
-from dataviewerapi import db, app, models
+from dataviewerapi import db, app, models, responses
+from dataviewerapi.binary import MEDIA_TYPE, accepts_frames, frames
+from dataviewerapi.expressions import hold
+from dataviewerapi.rollups import ROLLUP_ALIAS, available_rollups, choose_rollup, combined_stats, raw_stats, \
+    rollup_source, table_times
+
+
+@dataclass
+class DaySchema:
+    """
+    Columns and rollups of a testing day table, as last read
+    """
+    # creation times of the table and its rollups, if the database gives them
+    tables: Optional[dict]
+    names: List[str]
+    rollups: List[int]
+    checked: float
+
+
+_schemas: Dict[str, DaySchema] = {}
+_schemas_lock = threading.Lock()
+
+
+def read_day_schema(date: datetime.date) -> DaySchema:
+    """
+    Columns and rollups of a testing day table, cached per process. After TESTING_SCHEMA_TTL seconds the creation
+    times of the table and its rollups are checked again, and everything is re-read if the table was reloaded or
+    altered or its rollups rebuilt (or always, if the database doesn't give creation times)
+    """
+    table = date.strftime('%Y%m%d')
+    now = time.monotonic()
+    with _schemas_lock:
+        schema = _schemas.get(table)
+    if schema is not None and now - schema.checked < app.config["TESTING_SCHEMA_TTL"]:
+        return schema
+    tables = table_times(table)
+    if schema is None or tables is None or tables != schema.tables:
+        names = [c["name"] for c in inspect(db.engine).get_columns(table) if c["name"] != 'index']
+        schema = DaySchema(tables, names, available_rollups(table, tables), now)
+    else:
+        schema = DaySchema(schema.tables, schema.names, schema.rollups, now)
+    with _schemas_lock:
+        _schemas[table] = schema
+    return schema
 
 
 def read_variable_names(date: datetime.date):
@@ -18,8 +68,7 @@ def read_variable_names(date: datetime.date):
     :param date: Testing day (to determine appropriate database table)
     :return: list of names of variables
     """
-    columns = db.engine.execute(f"SELECT * FROM `{date.strftime('%Y%m%d')}` LIMIT 1").keys()
-    return list(filter(lambda column: column != 'index', columns))
+    return read_day_schema(date).names
 
 
 def interval_bounds_ms_since_start(date: datetime.date, table_epoch: datetime.time,
@@ -40,20 +89,24 @@ def interval_bounds_ms_since_start(date: datetime.date, table_epoch: datetime.ti
     return st, et
 
 
+# width (ms) of the buckets averaged together at each resolution, None for raw rows
 RESOLUTIONS = {
-    'all': '',
-    '1ms': 'GROUP BY `index`',
-    '10ms': 'GROUP BY `index` DIV 10',
-    '100ms': 'GROUP BY `index` DIV 100',
-    '1s': 'GROUP BY `index` DIV 1000',
-    '10s': 'GROUP BY `index` DIV 10000',
-    '1m': 'GROUP BY `index` DIV 60000',
+    'all': None,
+    '1ms': 1,
+    '10ms': 10,
+    '100ms': 100,
+    '1s': 1000,
+    '10s': 10000,
+    '1m': 60000,
 }
+# per bucket aggregates that can be requested when data is resampled
+AGGREGATES = ('avg', 'min', 'max', 'first', 'last')
 
 
 class OutputModes(Enum):
     JSON = 1
     CSV = 2
+    BINARY = 3
 
 
 @app.route("/api/v2/testing", methods=["GET"])
@@ -87,8 +140,8 @@ def list_testing_days():
 @app.route("/api/v2/testing/<day:date>", methods=["GET"])
 def read_testing_day(date):
     t = models.TestingDay.query.get_or_404(date, description='Date not found')
-    varnames = read_variable_names(t.date)
-    variables = models.Variable.query.filter(models.Variable.name.in_(varnames)).all()
+    # only the column names are cached, the variables' details can be edited at any time
+    variables = models.Variable.query.filter(models.Variable.name.in_(read_day_schema(t.date).names)).all()
     return jsonify({
         "date": t.date.isoformat(),
         "location": t.location,
@@ -123,14 +176,23 @@ def read_time_interval_kpis(date, start, end):
     if end < t.start: return abort(400, 'End time out of range')
     datestr = date.strftime('%Y%m%d')
 
-    # Get all variables present here, build SQL query to retrieve aggregate information
-    variables = read_variable_names(date)
-    kpistr = ', '.join((f'MIN(`{v}`), MAX(`{v}`), AVG(`{v}`), STD(`{v}`)' for v in variables))
-
     # Build interval bounds as milliseconds since start
     st, et = interval_bounds_ms_since_start(date, t.start, start, end)
+
+    # Get all variables present here, build SQL query to retrieve aggregate information, from the coarsest rollup
+    # with whole buckets in the interval if there is one
+    schema = read_day_schema(date)
+    variables = schema.names
+    rollup = choose_rollup(schema.rollups, None, st, et)
+    if rollup is None:
+        source = f'`{datestr}`'
+        kpistr = ', '.join((f'MIN(`{v}`), MAX(`{v}`), AVG(`{v}`), STD(`{v}`)' for v in variables))
+    else:
+        source = rollup_source(datestr, rollup, st, et, variables)
+        kpistr = ', '.join((', '.join(combined_stats(ROLLUP_ALIAS, v)[stat] for stat in ('min', 'max', 'avg', 'std'))
+                            for v in variables))
     # Retrieve information
-    query = f"SELECT {kpistr} FROM `{datestr}` WHERE `index` BETWEEN {st} AND {et}"
+    query = f"SELECT {kpistr} FROM {source} WHERE `index` BETWEEN {st} AND {et}"
     row = db.engine.execute(query).fetchone()
     # Build dictionary per variable
     data = {}
@@ -143,50 +205,92 @@ def read_time_interval_kpis(date, start, end):
 # JSON average row length: 782
 
 
-@app.route("/api/v2/testing/<day:date>/<time:start>/<time:end>/data", methods=["GET"])
-@app.route("/api/v2/testing/<day:date>/<time:start>/<time:end>/data.<ext>", methods=["GET"])
-def read_time_interval_data(date, start, end, ext=None):
-    t = models.TestingDay.query.get_or_404(date, description='Date not found')
+def build_interval_query(t: models.TestingDay, date: datetime.date, start: datetime.time, end: datetime.time,
+                         other_variables: Collection[str] = ()):
+    """
+    Build the query reading an interval of a testing day, from the resolution, agg and variables arguments of the
+    current request
+    :param other_variables: names of variables that may be requested even though this day doesn't have them, which
+                            are then read as NULL
+    :return: (query, names of the columns it selects after the index, (first, last) index it reads)
+    """
     datestr = date.strftime('%Y%m%d')
 
     # Sanity checking
-    if start < t.start: return abort(400, 'Start time out of range')
-    if end < t.start: return abort(400, 'End time out of range')
+    if start < t.start: abort(400, 'Start time out of range')
+    if end < t.start: abort(400, 'End time out of range')
 
     # Read resolution argument. Allows selecting how much data to return, aggregated
     resolution = request.args.get('resolution', default='1ms')
     if resolution not in RESOLUTIONS.keys():
-        return {'message': 'Unsupported resolution'}, 400
-    # Build the GROUP BY argument
-    group_by = RESOLUTIONS[resolution]
+        abort(400, 'Unsupported resolution')
+    width = RESOLUTIONS[resolution]
+    # Aggregates of each bucket to return, avg under the variable's own name and the others as "<variable>.<agg>"
+    aggregates = list(dict.fromkeys(request.args.get('agg', default='avg').split(',')))
+    if any(a not in AGGREGATES for a in aggregates):
+        abort(400, 'Unsupported aggregate')
 
     # Get the variables requested. Allows selecting which variables we want to read
-    possible_variables = set(read_variable_names(date))
+    schema = read_day_schema(date)
+    possible_variables = set(schema.names)
     variables = request.args.get('variables', default='all')
     if variables == 'all':
-        variables = possible_variables
+        variables = schema.names
     else:
         variables = variables.split(',')
         # some security to prevent SQL injection, and make sure at least one is selected
-        if len(variables) < 1: return {'message': 'No variables selected'}, 400
+        if len(variables) < 1: abort(400, 'No variables selected')
         for v in variables:
-            if v not in possible_variables: return {'message': 'Missing or unknown variable'}, 400
-    # Build SELECT argument for index column and all selected columns
-    if 'GROUP BY' not in group_by.upper():
-        selection = '`index`, ' + ', '.join((f'`{v}`' for v in variables))
-    else:  # need to aggregate
-        selection = 'MIN(`index`) as `index`, ' + ', '.join((f'AVG(`{v}`) AS `{v}`' for v in variables))
-
-    # Check whether user wants CSV or JSON output, from Accept header and extension
+            if v not in possible_variables and v not in other_variables:
+                abort(400, 'Missing or unknown variable')
+    st, et = interval_bounds_ms_since_start(date, t.start, start, end)
+    # Build SELECT and GROUP BY arguments for index column and all selected columns. Aggregates are read from the
+    # coarsest rollup whose buckets fit into the requested ones, if there is one
+    present = [v for v in variables if v in possible_variables]
+    rollup = choose_rollup(schema.rollups, width, st, et) if width is not None and len(present) > 0 else None
+    table = datestr if rollup is None else ROLLUP_ALIAS
+    if width is None:
+        columns = list(variables)
+        selection = '`index`, ' + ', '.join((f'`{v}`' if v in possible_variables else f'NULL AS `{v}`'
+                                             for v in variables))
+        group_by = ''
+    else:
+        stats = raw_stats if rollup is None else combined_stats
+        columns, selection = [], 'MIN(`index`) as `index`'
+        for v in variables:
+            for a in aggregates:
+                columns.append(v if a == 'avg' else f'{v}.{a}')
+                expr = stats(table, v)[a] if v in possible_variables else 'NULL'
+                selection += f', {expr} AS `{columns[-1]}`'
+        if rollup is None:  # need to aggregate
+            group_by = 'GROUP BY `index`' + (f' DIV {width}' if width > 1 else '')
+        else:
+            group_by = f'GROUP BY `index` DIV {width}'
+
+    if rollup is None:
+        source = f'`{datestr}`'
+    else:
+        source = rollup_source(datestr, rollup, st, et, present)
+    return f'SELECT {selection} FROM {source} WHERE `index` BETWEEN {st} AND {et} {group_by}', columns, (st, et)
+
+
+@app.route("/api/v2/testing/<day:date>/<time:start>/<time:end>/data", methods=["GET"])
+@app.route("/api/v2/testing/<day:date>/<time:start>/<time:end>/data.<ext>", methods=["GET"])
+def read_time_interval_data(date, start, end, ext=None):
+    t = models.TestingDay.query.get_or_404(date, description='Date not found')
+    datestr = date.strftime('%Y%m%d')
+    query, columns, _ = build_interval_query(t, date, start, end)
+    schema = read_day_schema(date)
+
+    # Check whether user wants CSV, binary or JSON output, from Accept header and extension
     accept = request.headers.get('Accept', default='*/*')
     if 'text/csv' in accept.lower() or ext == 'csv':
         output = OutputModes.CSV
+    elif accepts_frames() or ext == 'bin':
+        output = OutputModes.BINARY
     else:
         output = OutputModes.JSON
 
-    st, et = interval_bounds_ms_since_start(date, t.start, start, end)
-    query = f'SELECT {selection} FROM `{datestr}` WHERE `index` BETWEEN {st} AND {et} {group_by}'
-
     # Build last-modified
     dayend = datetime.datetime.combine(date, t.end)
     timezone = pytz.timezone(t.timezone)
@@ -201,39 +305,362 @@ def read_time_interval_data(date, start, end, ext=None):
         else:
             print('old!')
 
-    return Response(load_and_emit_data(query, output, daystart), 200, {
+    headers = {
         # TODO need to make more robust if data added in middle
         "Last-Modified": dayend.strftime("%a, %d %b %Y %H:%M:%S") + " GMT",
         "Cache-Control": "must-revalidate",
-        "Content-Type": "application/json" if output == OutputModes.JSON else "text/csv",
-    })
+        "Content-Type": {OutputModes.JSON: "application/json", OutputModes.CSV: "text/csv",
+                         OutputModes.BINARY: MEDIA_TYPE}[output],
+        "Vary": "Accept, Accept-Encoding",
+    }
+    # once the day is over its results can't change, unless the table itself is reloaded, which is part of the key
+    key = None
+    if responses.enabled() and datetime.datetime.now(datetime.timezone.utc) >= dayend:
+        key = responses.day_key(datestr, query, output.name, daystart, schema.tables)
+    cached = responses.get(key) if key is not None else None
+    if cached is not None:
+        if responses.accepts_gzip():
+            return Response(cached, 200, dict(headers, **{"Content-Encoding": "gzip"}))
+        return Response(responses.decompressed(cached), 200, headers)
+
+    if output == OutputModes.BINARY:
+        body = load_and_emit_frames(query, columns, daystart)
+    else:
+        body = load_and_emit_data(query, output, columns, daystart)
+    if key is not None:
+        body = responses.storing(key, body)
+    return Response(body, 200, headers)
 
 
-def load_and_emit_data(query, output, epoch):  # to stream results with yield instead of buffering everything in memory
-    with db.engine.connect() as conn:
-        # Enable SQL streaming query results mode. Requires MySQLdb driver.
-        # This prevents the app from trying to load massive datasets in memory and crasing
-        conn = conn.execution_options(stream_results=True, max_row_buffer=10000)
-        # Read each chunk of results into separate dataframe
-        for i, df in enumerate(pd.read_sql(query, conn, index_col='index', chunksize=10000)):
-            # Interpolate data. TODO: make optional
-            df = df.ffill().bfill()
-            # Generate output for selected format
-            if output == OutputModes.JSON:
-                df['time'] = (pd.to_timedelta(df.index, unit='ms') + epoch).strftime(
-                    '%Y-%m-%dT%H:%M:%S.%f')  # todo timezone
-                if i == 0:  # need to manually add start of list character
-                    pp = '['
-                else:
-                    pp = ','  # need to manually add separator character
-                yield pp + df.to_json(orient='records')[1:-1]
-            elif output == OutputModes.CSV:
-                df.index = (pd.to_timedelta(df.index, unit='ms') + epoch).strftime(
-                    '%Y-%m-%d %H:%M:%S.%f')  # todo timezone
-                if i == 0:
-                    yield df.to_csv(header=True)  # print spreadsheet header at the beginning only
-                else:
-                    yield df.to_csv(header=False)
+# rows fetched from the cursor at a time
+BATCH_ROWS = 10000
+
+
+def row_batches(query):
+    """
+    Stream query results as lists of plain tuples, straight from a DBAPI cursor: every column is a number, so there's
+    nothing for SQLAlchemy to process, and building its row objects costs more than reading the rows
+    """
+    connection = db.engine.raw_connection()
+    try:
+        if db.engine.dialect.driver == 'mysqldb':
+            # MySQLdb would otherwise load the whole result in memory
+            import MySQLdb.cursors
+            cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+        else:
+            cursor = connection.cursor()
+        try:
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(BATCH_ROWS)
+                if len(rows) == 0:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+
+
+def filled_batches(query, on_batch: Optional[Callable[[int], None]] = None):
+    """
+    Stream query results from the cursor into arrays, a batch of rows at a time. Gaps in each column are filled with
+    its last value, carried over from earlier batches. Gaps before a column's first value are filled with that value
+    only within the batch it appears in, as the per-chunk bfill this replaces did: earlier batches stay NaN rather
+    than being held back until every column has a value, which could be the whole result
+    :param query: selects the index column followed by one column per variable
+    :param on_batch: called with the last index of each batch read
+    :return: generator of (index, values) with values holding one float64 column per variable
+    """
+    last = None
+    for rows in row_batches(query):
+        data = np.array(rows, dtype=np.float64)
+        del rows
+        index, values = data[:, 0].astype(np.int64), data[:, 1:]
+        if last is not None:
+            values = hold(np.concatenate([last, values]))[1:]
+        else:
+            values = hold(values)
+        last = values[-1:]
+        if on_batch is not None:
+            on_batch(int(index[-1]))
+        # columns without any value so far take their first value from later in the batch, if it has one
+        yield index, hold(values[::-1])[::-1]
+
+
+def format_times(index: np.ndarray, epoch: datetime.datetime, sep: str) -> List[str]:
+    times = np.datetime64(epoch, 'us') + index.astype('timedelta64[ms]')
+    strings = np.datetime_as_string(times, unit='us')
+    return strings.tolist() if sep == 'T' else np.char.replace(strings, 'T', sep).tolist()
+
+
+def run_starts(values: np.ndarray) -> np.ndarray:
+    """
+    Mask of the values that differ from the one before. Filled columns mostly repeat the same value, so each run of a
+    value only needs formatting once
+    """
+    changes = np.empty(values.shape, dtype=bool)
+    changes[:1] = True
+    np.not_equal(values[1:], values[:-1], out=changes[1:])
+    return changes
+
+
+def format_values(values: np.ndarray, missing: str) -> List[str]:
+    """
+    Shortest round-tripping text of each value of a column, as written to CSV
+    """
+    changes = run_starts(values)
+    distinct = values[changes]
+    strings = json.dumps(distinct.tolist())[1:-1].split(', ')
+    for i in np.flatnonzero(~np.isfinite(distinct)):
+        strings[i] = missing
+    return np.array(strings, dtype=object)[np.cumsum(changes) - 1].tolist()
+
+
+# decimals of numbers in JSON output
+JSON_DECIMALS = 10
+# numbers this large are written as repr does, rather than in fixed point
+JSON_LARGE = 1e16
+
+
+def json_numbers(values: np.ndarray) -> np.ndarray:
+    """
+    JSON text of each value of a column as it was written by pandas' to_json: fixed point rounded to JSON_DECIMALS
+    decimals without trailing zeros, and null for NaN. Digits are worked out for all values at once with integer
+    arithmetic rather than formatting each
+    :return: uint8 array of ASCII, a row per value padded with NUL bytes
+    """
+    changes = run_starts(values)
+    distinct = values[changes]
+    finite = np.isfinite(distinct)
+    magnitude = np.where(finite, np.abs(distinct), 0)
+    large = magnitude >= JSON_LARGE
+    magnitude[large] = 0
+    # split into whole part and decimals, rounding half to even
+    whole = np.floor(magnitude)
+    scaled = (magnitude - whole) * 10.0 ** JSON_DECIMALS
+    decimals = np.floor(scaled)
+    rest = scaled - decimals
+    whole, decimals = whole.astype(np.int64), decimals.astype(np.int64)
+    decimals += (rest > 0.5) | ((rest == 0.5) & ((decimals == 0) | (decimals % 2 == 1)))
+    carry = decimals >= 10 ** JSON_DECIMALS
+    whole += carry
+    decimals[carry] = 0
+
+    # only as many columns as the widest value of this batch needs
+    sign = int(np.any(distinct < 0))
+    whole_digits = len(str(whole.max())) if whole.shape[0] > 0 else 1
+    width = max(sign + whole_digits + 1 + JSON_DECIMALS, 25 if np.any(large & finite) else 0)
+    out = np.zeros((distinct.shape[0], width), dtype=np.uint8)
+    if sign:
+        out[:, 0] = np.where(distinct < 0, ord('-'), 0)
+    # digits from the last, dropping leading zeros of the whole part and trailing zeros of the decimals
+    for i in reversed(range(whole_digits)):
+        digits = whole % 10
+        out[:, sign + i] = np.where((whole > 0) | (i == whole_digits - 1), digits + ord('0'), 0)
+        whole //= 10
+    out[:, sign + whole_digits] = ord('.')
+    significant = np.zeros(decimals.shape, dtype=bool)
+    for i in reversed(range(JSON_DECIMALS)):
+        decimals, digits = np.divmod(decimals, 10)
+        if i > 0:
+            significant |= digits != 0
+        out[:, sign + whole_digits + 1 + i] = np.where(significant | (i == 0), digits + ord('0'), 0)
+
+    out[~finite] = 0
+    out[~finite, :4] = np.frombuffer(b'null', dtype=np.uint8)
+    for i in np.flatnonzero(large & finite):
+        text = repr(float(distinct[i])).encode()
+        out[i] = 0
+        out[i, :len(text)] = np.frombuffer(text, dtype=np.uint8)
+    return out[np.cumsum(changes) - 1]
+
+
+def json_records(index: np.ndarray, values: np.ndarray, variables, epoch) -> bytes:
+    """
+    JSON records of a batch, each preceded by a comma. The whole batch is laid out as one byte array, with every
+    field at a fixed offset in its row, and the NUL bytes padding them are then dropped
+    """
+    parts = []
+    for col, v in enumerate(variables):
+        parts += [(',' if col > 0 else ',{') + json.dumps(v) + ':', json_numbers(values[:, col])]
+    times = np.datetime_as_string(np.datetime64(epoch, 'us') + index.astype('timedelta64[ms]'), unit='us')
+    parts += [(',' if len(variables) > 0 else ',{') + '"time":"', times.astype('S26').view(np.uint8).reshape(-1, 26),
+              '"}']
+    rows = np.empty((index.shape[0], sum(len(p) if isinstance(p, str) else p.shape[1] for p in parts)),
+                    dtype=np.uint8)
+    offset = 0
+    for part in parts:
+        if isinstance(part, str):
+            part = np.frombuffer(part.encode(), dtype=np.uint8)
+            rows[:, offset:offset + part.shape[0]] = part
+        else:
+            rows[:, offset:offset + part.shape[1]] = part
+        offset += part.shape[-1]
+    return rows.tobytes().translate(None, b'\0')
+
+
+def load_and_emit_data(query, output, variables, epoch, on_batch=None):
+    """
+    Stream query results as JSON records or CSV rows, a batch at a time. Every value of a batch is formatted in one go,
+    and for CSV each row is then a single string formatting operation
+    """
+    first = True
+    for index, values in filled_batches(query, on_batch):
+        if output == OutputModes.JSON:
+            yield ('[' if first else ',') + json_records(index, values, variables, epoch)[1:].decode('ascii')
+        else:
+            if first:  # print spreadsheet header at the beginning only
+                yield ','.join(['index'] + list(variables)) + '\n'
+            row = ','.join(['%s'] * (len(variables) + 1))
+            columns = [format_values(values[:, col], '') for col in range(values.shape[1])]
+            times = format_times(index, epoch, ' ')
+            yield '\n'.join(map(row.__mod__, zip(times, *columns))) + '\n'
+        first = False
 
     if output == OutputModes.JSON:
+        yield '[]' if first else ']'
+
+
+def load_and_emit_frames(query, variables, epoch, on_batch=None):
+    """
+    Stream query results as framed binary columns: "index" (int64 ms since epoch, given in the header) and a float64
+    column per variable. Each chunk of rows goes from the cursor straight into arrays
+    """
+    columns = [('index', np.int64)] + [(v, np.float64) for v in variables]
+
+    def batches():
+        for index, values in filled_batches(query, on_batch):
+            yield [index] + [values[:, col] for col in range(values.shape[1])]
+    return frames(columns, batches(), epoch=epoch.isoformat())
+
+
+# chunks a slice's query may run ahead of the response before its thread waits
+SLICE_QUEUE_CHUNKS = 4
+
+
+def read_slices() -> List[tuple]:
+    """
+    Slices of testing days selected by the JSON body of the current request, one of "intervals" (a list of IDs),
+    "type" (every interval of that type, optionally only "from" and/or "to" a date) or "ranges" (a list of
+    {"date", "start", "end"})
+    :return: list of (interval ID or None, date, start, end)
+    """
+    body = request.get_json(silent=True) or {}
+    if 'intervals' in body or 'type' in body:
+        q = models.Interval.query
+        if 'intervals' in body:
+            if not isinstance(body['intervals'], list) or not all(isinstance(i, int) for i in body['intervals']):
+                abort(400, '"intervals" must be a list of IDs')
+            q = q.filter(models.Interval.id.in_(body['intervals']))
+        else:
+            q = q.filter(models.Interval.type == body['type'])
+            try:
+                if body.get('from') is not None:
+                    q = q.filter(models.Interval.date >= datetime.date.fromisoformat(body['from']))
+                if body.get('to') is not None:
+                    q = q.filter(models.Interval.date <= datetime.date.fromisoformat(body['to']))
+            except (TypeError, ValueError):
+                abort(400, '"from" and "to" must be dates')
+        return [(i.id, i.date, i.start, i.end) for i in q.order_by(models.Interval.date, models.Interval.start)]
+    if 'ranges' in body:
+        try:
+            return [(None, datetime.date.fromisoformat(r['date']), datetime.time.fromisoformat(r['start']),
+                     datetime.time.fromisoformat(r['end'])) for r in body['ranges']]
+        except (KeyError, TypeError, ValueError):
+            abort(400, '"ranges" must be a list of {"date", "start", "end"}')
+    abort(400, 'Missing required parameters: "intervals", "type" or "ranges"')
+
+
+def concurrent_chunks(bodies: List[Callable[[], Iterable[str]]], threads: int) -> Iterator[str]:
+    """
+    Produce several streamed bodies on a pool of threads, each with its own database connection, and yield all their
+    chunks one body after the other. Each thread runs at most SLICE_QUEUE_CHUNKS chunks ahead, and all of them stop
+    once the consumer does
+    """
+    stop = threading.Event()
+    done = object()
+    queues = [Queue(maxsize=SLICE_QUEUE_CHUNKS) for _ in bodies]
+
+    def put(queue: Queue, item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce(body, queue):
+        try:
+            with app.app_context():
+                chunks = body()
+                try:
+                    for chunk in chunks:
+                        if not put(queue, chunk):
+                            return
+                finally:
+                    # ends the query and returns its connection right away
+                    chunks.close()
+        except Exception as e:
+            put(queue, e)
+        else:
+            put(queue, done)
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    # bodies start in order, so the one being consumed has always started
+    futures = [executor.submit(produce, body, queue) for body, queue in zip(bodies, queues)]
+    try:
+        for queue in queues:
+            while True:
+                item = queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+@app.route("/api/v2/testing/slices", methods=["POST"])
+def read_slices_data():
+    """
+    Data of many intervals, possibly on different testing days, in one JSON response: a list of {"interval" (ID, or
+    null for ranges), "date", "start", "end", "data"}, where data is as the data endpoint returns it for the same
+    resolution, agg and variables arguments. Requested variables that a day doesn't have are null throughout its slices
+    """
+    slices = read_slices()
+    days = {d.date: d for d in models.TestingDay.query.filter(
+        models.TestingDay.date.in_({date for _, date, _, _ in slices})).all()}
+    for _, date, start, end in slices:
+        if date not in days: abort(404, f'Date {date.isoformat()} not found')
+        if end < start: abort(400, 'Start and end are out of order')
+    names = set()
+    for date in days:
+        names.update(read_day_schema(date).names)
+
+    # build every query first, so bad arguments fail before anything is sent
+    bodies = []
+    for i, (interval_id, date, start, end) in enumerate(slices):
+        query, columns, _ = build_interval_query(days[date], date, start, end, other_variables=names)
+        header = json.dumps({"interval": interval_id, "date": date.isoformat(), "start": start.isoformat(),
+                             "end": end.isoformat()})[:-1]
+        epoch = datetime.datetime.combine(date, days[date].start)
+
+        def body(query=query, columns=columns, epoch=epoch, prefix=('[' if i == 0 else ',') + header + ',"data":'):
+            yield prefix
+            yield from load_and_emit_data(query, OutputModes.JSON, columns, epoch)
+            yield '}'
+        bodies.append(body)
+
+    def stream():
+        if len(bodies) == 0:
+            yield '[]'
+            return
+        yield from concurrent_chunks(bodies, app.config["TESTING_QUERY_THREADS"])
         yield ']'
+    return Response(stream(), 200, {"Content-Type": "application/json"})
@@ -1,14 +1,17 @@
+import json
 from typing import List
 
 import dateutil.parser
 import datetime
+import numpy as np
 from flask_restful import abort
-from sympy import sympify, SympifyError
+from sympy import SympifyError
 
 from werkzeug.routing import BaseConverter
 
-from dataviewerapi import models
+from dataviewerapi import db, models
 from dataviewerapi.data import RunDataPoints
+from dataviewerapi.expressions import expression_variables
 
 
 class IntSetConverter(BaseConverter):
@@ -47,6 +50,23 @@ class TimeConverter(BaseConverter):
 
 
 
+def json_array(values: np.ndarray, chunk_size=65536):
+    """
+    Encode a 1-D array as a JSON array, NaN as null, a chunk of values at a time. Each chunk is converted in one go
+    and handed to the C JSON encoder rather than formatting values one by one
+    """
+    yield '['
+    for start in range(0, values.shape[0], chunk_size):
+        chunk = values[start:start + chunk_size]
+        if chunk.dtype.kind == "f":
+            missing = np.isnan(chunk)
+            if missing.any():
+                chunk = chunk.astype(object)
+                chunk[missing] = None
+        yield ("," if start > 0 else "") + json.dumps(chunk.tolist())[1:-1]
+    yield ']'
+
+
 def validate_run_location(args):
     # check existence and length
     if args["location"] is None or not 0 < len(args["location"]) < 100:
@@ -65,22 +85,58 @@ def validate_run_type(args):
         abort(400, error="Type must be less than 100 characters")
 
 
-def get_included_variables(run: models.Run) -> List[models.Variable]:
-    with RunDataPoints(run.id) as data:
-        incl_vars = models.Variable.query.filter(models.Variable.id.in_(data.variables())).all()
+def from_ms(ms):
+    # naive UTC, as times are stored in the database
+    return None if ms is None else datetime.datetime.utcfromtimestamp(ms / 1000)
+
+
+def record_run_variables(run: models.Run, stats: List[dict]):
+    """
+    Store which variables a run contains
+    :param stats: {"id", "samples", "start", "end"} of each variable, times in ms since the epoch
+    """
+    known = {v.id for v in models.Variable.query.filter(models.Variable.id.in_([s["id"] for s in stats])).all()}
+    run.variables = [models.RunVariable(variable_id=s["id"], samples=s["samples"], start=from_ms(s["start"]),
+                                        end=from_ms(s["end"])) for s in stats if s["id"] in known]
+    run.catalogued = True
+    db.session.add(run)
+    db.session.commit()
 
-    return incl_vars
+
+def catalog_runs(runs: List[models.Run]):
+    """
+    Record the variables of runs imported before the catalog existed, from their data files
+    """
+    for run in runs:
+        if not run.catalogued:
+            with RunDataPoints(run.id) as data:
+                record_run_variables(run, data.variable_stats())
+
+
+def get_included_variables(run: models.Run) -> List[models.Variable]:
+    catalog_runs([run])
+    return models.Variable.query.join(models.RunVariable).filter(models.RunVariable.run_id == run.id).all()
 
 
 def get_appropriate_filters(included_variables: List[models.Variable]) -> List[models.Filter]:
-    incl_var_names = {v.name for v in included_variables}
-    filters = []
-    filter: models.Filter
-    for filter in models.Filter.query.all():
-        diff = filter.required_variables().difference(incl_var_names)
-        if len(diff) == 0:  # this means that f.required_vars includes all of incl_var_names
-            filters.append(filter)
-    return filters
+    incl_var_ids = {v.id for v in included_variables}
+    # filters requiring any variable outside the included ones
+    missing = db.session.query(models.FilterVariable.filter_id).filter(
+        models.FilterVariable.variable_id.notin_(incl_var_ids))
+    return models.Filter.query.filter(models.Filter.id.notin_(missing)).all()
+
+
+def get_runs_with_variables(variable_ids: List[int]) -> List[int]:
+    """
+    Runs that may contain all the given variables: those whose catalog has them, and those without a catalog yet
+    """
+    q = models.Run.query.filter(models.Run.start.isnot(None))
+    if len(variable_ids) > 0:
+        having = db.session.query(models.RunVariable.run_id).filter(
+            models.RunVariable.variable_id.in_(variable_ids)).group_by(models.RunVariable.run_id).having(
+            db.func.count() == len(set(variable_ids)))
+        q = q.filter(db.or_(models.Run.id.in_(having), ~models.Run.catalogued))
+    return [r.id for r in q.order_by(models.Run.id).all()]
 
 
 def validate_filter_name(args):
@@ -89,21 +145,27 @@ def validate_filter_name(args):
         abort(400, error="Filter name must contain only English letters/numbers and be less than 100 characters")
 
 
-def validate_filter_expression(args):
+def validate_filter_expression(args) -> List[models.Variable]:
+    """
+    :return: the variables the expression requires
+    """
     # check existence and length
     if args["expression"] is None or not 0 < len(args["expression"]) < 512:
         abort(400, error="Expression must be nonempty and less than 512 characters")
     # check if expression is valid math
-    variables = {v.name for v in models.Variable.query.all()}
     try:
         # below line will error if can't parse with sympy
-        expr = sympify(args["expression"])
-        # check that all implicitly-defined symbols are valid variables
-        for free in expr.expr_free_symbols:
-            if free.is_Symbol and free.name not in variables:
-                abort(400, error=f"Unknown variable referenced in equation: {free.name}")
+        names = expression_variables(args["expression"])
     except SympifyError as e:
         abort(400, error=f"Expression does not parse: {e}")
+    # a filter's values are computed at the time points of its variables, so a constant would never have any
+    if len(names) == 0:
+        abort(400, error="Expression must reference at least one variable")
+    # check that all implicitly-defined symbols are valid variables
+    variables = models.Variable.query.filter(models.Variable.name.in_(names)).all()
+    for name in set(names).difference(v.name for v in variables):
+        abort(400, error=f"Unknown variable referenced in equation: {name}")
+    return variables
 
 
 def validate_filter_description(args):
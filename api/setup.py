@@ -5,7 +5,7 @@ with open('requirements.txt') as f:
 setup(
     name='dataviewerapi',
     version='0.0.1',
-    packages=['dataviewerapi', 'dataviewerapi.routes'],
+    packages=['dataviewerapi', 'dataviewerapi.routes', 'dataviewerapi.jobs', 'canparser'],
     url='http://sae.wustl.edu',
     license='GPL-3.0+',
     author='Connor Monahan',
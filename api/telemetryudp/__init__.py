@@ -7,6 +7,8 @@ from functools import reduce
 import cantools.database
 from redis import StrictRedis
 
+from canparser import CompiledDecoder
+
 config = {
     "REDIS_URL": os.environ.get("REDIS_URL") or "redis://localhost:6379",
     "DBC": os.environ["DBC"],
@@ -18,6 +20,8 @@ class TelemetryServer:
         self.redis = StrictRedis.from_url(config["REDIS_URL"])
         self.logger = logging.getLogger(__name__ + ".TelemetryServer")
         self.dbc = cantools.database.load_file(config["DBC"])
+        # same decoder as run imports, so live values match the stored ones
+        self.decoder = CompiledDecoder(self.dbc)
 
     def handle(self, msg: bytes, rinfo):
         if len(msg) != 20:
@@ -35,7 +39,7 @@ class TelemetryServer:
             return
 
         try:
-            signals = self.dbc.decode_message(frame_id, data)
+            signals = self.decoder.decode_frame(frame_id, data)
         except KeyError:
             self.logger.warning(f"Message with id {frame_id} not found in DBC")
             return
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# the app reads its configuration when it's imported, so point it at scratch folders first
+_scratch = tempfile.mkdtemp(prefix="dataviewerapi-tests-")
+os.environ.update(DATA_FOLDER=os.path.join(_scratch, "runs"), UPLOAD_FOLDER=os.path.join(_scratch, "uploads"),
+                  DATABASE_URL="sqlite:///" + os.path.join(_scratch, "app.db"), DATA_BUCKET="", UPLOAD_BUCKET="")
@@ -0,0 +1,81 @@
+import datetime
+import faulthandler
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from dataviewerapi import app
+from dataviewerapi.jobs import run
+
+DBC = '''VERSION ""
+
+NS_ :
+
+BS_:
+
+BU_: DATALOGGER
+
+BO_ 512 DataLogger0: 8 DATALOGGER
+ SG_ CGAccelRawX : 0|16@1- (0.001,0) [-32|32] "G" Vector__XXX
+ SG_ CGAccelRawY : 16|16@1- (0.001,0) [-32|32] "G" Vector__XXX
+'''
+ROWS = 20000
+VARIABLES = [{"id": 1, "name": "CGAccelRawX"}, {"id": 2, "name": "CGAccelRawY"}]
+
+
+def write_log(path, short_row=None):
+    start = datetime.datetime(2019, 4, 13, 10, 0)
+    with open(path, "w") as f:
+        f.write("year,month,day,hour,min,sec,ms,id,data\n")
+        for i in range(ROWS):
+            t = start + datetime.timedelta(milliseconds=10 * i)
+            payload = f"{i % 65536:04X}{(7 * i) % 65536:04X}00000000"
+            if i == short_row:
+                payload = payload[:6]
+            f.write(f"{t.year},{t.month},{t.day},{t.hour},{t.minute},{t.second},{t.microsecond // 1000},200,"
+                    f"{payload}\n")
+
+
+@pytest.fixture
+def log_run(tmp_path, monkeypatch):
+    dbc_file = tmp_path / "test.dbc"
+    dbc_file.write_text(DBC)
+    monkeypatch.setitem(app.config, "DBC", str(dbc_file))
+    monkeypatch.setitem(app.config, "DATA_BUCKET", None)
+    monkeypatch.setattr(run.import_run, "update_state", lambda *args, **kwargs: None)
+
+    def import_log(run_id, short_row=None, processes=1):
+        write_log(os.path.join(app.config["UPLOAD_FOLDER"], f"{run_id}.csv"), short_row)
+        monkeypatch.setitem(app.config, "IMPORT_PROCESSES", processes)
+        monkeypatch.setitem(app.config, "IMPORT_CHUNK_SIZE", 64 * 1024)
+        result = run.import_run.run(run_id, VARIABLES)
+        with h5py.File(os.path.join(app.config["DATA_FOLDER"], f"{run_id}.h5"), "r") as f:
+            return result, f["timestamps"][:], f["data"][:]
+    return import_log
+
+
+def test_parallel_import_matches_sequential(log_run):
+    _, timestamps, data = log_run(1)
+    result, parallel_timestamps, parallel_data = log_run(2, processes=4)
+    assert result["status"] == 10
+    assert timestamps.shape == (ROWS,)
+    np.testing.assert_array_equal(parallel_timestamps, timestamps)
+    np.testing.assert_array_equal(parallel_data, data)
+
+
+def test_parallel_import_stops_at_malformed_row(log_run):
+    # the short payload lands in an early piece of the log, with later pieces still queued or being decoded
+    faulthandler.dump_traceback_later(120, exit=True)
+    try:
+        result, timestamps, data = log_run(3, short_row=ROWS // 4, processes=4)
+    finally:
+        faulthandler.cancel_dump_traceback_later()
+    _, expected_timestamps, expected_data = log_run(4, short_row=ROWS // 4)
+    assert result["status"] == 10
+    assert timestamps.shape == (ROWS // 4,)
+    np.testing.assert_array_equal(timestamps, expected_timestamps)
+    np.testing.assert_array_equal(data, expected_data)
+    # pieces decoded past the malformed row are thrown away with their temporary folder
+    assert all(name.endswith(".h5") for name in os.listdir(app.config["DATA_FOLDER"]))